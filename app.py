@@ -1,14 +1,26 @@
-from flask import Flask, request, jsonify, session, send_file, render_template
+from flask import Flask, Response, request, jsonify, session, redirect, render_template, stream_with_context
 from flask_session import Session
 from flask_cors import CORS
-import zipfile
-from io import BytesIO
 from bs4 import BeautifulSoup
 import os
 import json
-import requests
+import itertools
+import upstream
+import chapters
+import archive
+import cache
+import delivery
+import objectstore
+import jobs
+import prefetch
+import bandwidth
+import searchcache
+import sites
 import tempfile
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+import google.auth
 import google.cloud.logging
 from google.cloud.logging.handlers import CloudLoggingHandler
 from google.cloud import storage
@@ -42,8 +54,44 @@ app.config['PERMANENT_SESSION_LIFETIME'] = 3600  # Sessions expire in 1 hour
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['SESSION_COOKIE_SECURE'] = True  # Ensure secure cookies over HTTPS
 
-# Initialize Google Cloud Storage
-storage_client = storage.Client()
+# Search fan-out configuration
+app.config['SEARCH_SITE_TIMEOUT'] = 8  # Seconds each site has to answer, unless knownSites.json sets search_timeout
+app.config['SEARCH_BUDGET'] = 12  # Seconds a whole search may take across every site
+app.config['SEARCH_WORKERS'] = 16  # Threads shared by all searches in this worker
+app.config['SEARCH_CACHE_FRESH'] = 600  # Seconds a site's results are reused without searching it again
+app.config['SEARCH_CACHE_STALE'] = 3600  # Seconds after that they are still served while refreshed in the background
+app.config['SEARCH_CACHE_MISS'] = 300  # Seconds a site that found nothing is skipped for the same search
+app.config['SEARCH_CACHE_ENTRIES'] = 1024  # Searches kept in memory by each worker
+app.config['SEARCH_CACHE_REDIS'] = 'redis://localhost:6379/0'  # Cache shared by every worker; None keeps it per worker
+
+# Audiobook content cache configuration
+app.config['CACHE_DIR'] = '/home/adamjoelblake/audioScraper/cache'  # Chapters and finished archives on local disk
+app.config['CACHE_MAX_BYTES'] = 20 * 1024 ** 3  # Least recently used items are evicted past this size
+app.config['ARCHIVE_SPOOL_BYTES'] = 32 * 1024 ** 2  # Archives built whole are kept in memory up to this size
+app.config['ARCHIVE_SPOOL_DIR'] = os.path.join(app.config['CACHE_DIR'], 'pending')  # Local disk they spill onto past that
+app.config['OBJECT_STORE'] = 'gcs'  # 'gcs' uses bucket_name, 'local' uses OBJECT_STORE_DIR, None disables the tier
+app.config['OBJECT_STORE_DIR'] = '/home/adamjoelblake/audioScraper/objects'
+
+# Background download job configuration
+app.config['JOBS_DIR'] = '/home/adamjoelblake/audioScraper/jobs'  # Job state shared by every worker
+app.config['JOB_WORKERS'] = 2  # Archives assembled at once in this worker
+
+# Speculative chapter prefetch configuration
+app.config['PREFETCH_CHAPTERS'] = 10  # Chapters warmed per user as soon as a book is selected
+app.config['PREFETCH_WORKERS'] = 2  # Users prefetched for at once in this worker
+
+# Bandwidth shaping configuration, in bytes per second for the whole VM; None lifts the ceiling.
+# Each gunicorn worker paces only its own traffic, so it is given an equal slice of the ceiling
+# and shares that fairly between its own users; a slice an idle worker leaves is not lent out.
+app.config['WORKERS'] = int(os.environ.get('WEB_CONCURRENCY', 1))  # gunicorn's default worker count
+app.config['BANDWIDTH_INGRESS'] = 50 * 1024 ** 2  # Chapter downloads from upstream, shared fairly between users
+# Downloads to clients, shared fairly between users. Off by default: a ceiling reads every cached
+# file through Python to pace it, where unpaced files are handed to gunicorn to sendfile()
+app.config['BANDWIDTH_EGRESS'] = None
+
+# Initialize Google Cloud Storage, keeping its credentials to sign download URLs with
+storage_credentials, storage_project = google.auth.default(scopes=storage.Client.SCOPE)
+storage_client = storage.Client(project=storage_project, credentials=storage_credentials)
 bucket_name = 'audiobook-bucket-22/'
 
 # Ensure the session directory exists
@@ -53,22 +101,47 @@ if not os.path.exists(app.config['SESSION_FILE_DIR']):
 # Initialize session
 Session(app)
 
+# Initialize the object store tier and the on-disk chapter and archive cache in front of it
+if app.config['OBJECT_STORE'] == 'gcs':
+    contentStore = objectstore.GcsStore(storage_client.bucket(bucket_name.strip('/')), storage_credentials)
+elif app.config['OBJECT_STORE'] == 'local':
+    contentStore = objectstore.LocalStore(app.config['OBJECT_STORE_DIR'], app.secret_key)
+else:
+    contentStore = None
+contentCache = cache.DiskCache(app.config['CACHE_DIR'], app.config['CACHE_MAX_BYTES'], store=contentStore)
+
+# Ensure the archive spool directory exists, in case it is set somewhere outside the cache
+os.makedirs(app.config['ARCHIVE_SPOOL_DIR'], exist_ok=True)
+
+# Initialize background download jobs
+downloadJobs = jobs.JobStore(app.config['JOBS_DIR'], workers=app.config['JOB_WORKERS'])
+
+# Initialize bandwidth shaping
+def workerShare(rate):
+    return rate / app.config['WORKERS'] if rate else None
+bandwidth.ingress.setRate(workerShare(app.config['BANDWIDTH_INGRESS']))
+bandwidth.egress.setRate(workerShare(app.config['BANDWIDTH_EGRESS']))
+
+# Initialize speculative chapter prefetch
+chapterPrefetcher = prefetch.Prefetcher(contentCache, workers=app.config['PREFETCH_WORKERS'], maxChapters=app.config['PREFETCH_CHAPTERS'])
+
 # Enable CORS for all routes
 CORS(app, resources={r"/*": {"origins": "*"}},
      supports_credentials=True, 
      methods=["GET", "POST", "OPTIONS"],
      allow_headers=["Content-Type", "Authorization", "Access-Control-Allow-Credentials"])
 
-# Known site information
-def getKnownSites():
-    try:
-        with open('knownSites.json', 'r') as file:
-            data = json.load(file)
-        return data
-    except Exception as e:
-        cloud_logger.info(f"Error in main function getKnownSites: {e}")
-knownSitesJson = getKnownSites()
-siteNames = knownSitesJson.keys()
+# Known site information, validated and compiled into extraction plans once
+knownSites = sites.loadSites('knownSites.json')
+siteNames = knownSites.keys()
+
+# Thread pool used to query every known site at once
+searchExecutor = ThreadPoolExecutor(max_workers=app.config['SEARCH_WORKERS'], thread_name_prefix='search')
+
+# Search results per site, shared with the other workers through Redis
+searchCache = searchcache.SearchCache(app.config['SEARCH_CACHE_REDIS'], fresh=app.config['SEARCH_CACHE_FRESH'],
+                                      stale=app.config['SEARCH_CACHE_STALE'], miss=app.config['SEARCH_CACHE_MISS'],
+                                      maxEntries=app.config['SEARCH_CACHE_ENTRIES'])
 
 @app.route('/')
 def home():
@@ -88,43 +161,61 @@ def scrapeBookOptions():
     cloud_logger.info(f"Book title: {book_title}")
     bookDict = {'title': book_title, 'author': book_author}
 
-    # First half of main function
-    for site in siteNames:
-        cloud_logger.info(f"Calling getQueryUrl with {bookDict}")
-        queryUrl = getQueryUrl(site, bookDict)
-        cloud_logger.info(f"Query URL: {queryUrl}")
-
-        cloud_logger.info("Calling cookSoup")
-        soup = cookSoup(queryUrl)
-        cloud_logger.info(f"Soup created: {soup}")
-
-        cloud_logger.info("Getting book options")
-        bookOptions = getBookOptions(soup, bookDict, site)
-        for book in bookOptions:
-            cloud_logger.info(f"Entry Title: {book}")
-        
-        if bookOptions:
-            # Cache the book options
-            cloud_logger.info(f"Storing data locally")
-            try:
-                cloud_logger.info(f"BOOK OPTIONS")
-            except Exception as e:
-                cloud_logger.info(f"Unable to store bookOptions locally.")
-            try:
-                session['bookDict'] = bookDict
-            except Exception as e:
-                cloud_logger.info(f"Unable to store bookDict locally.")
-            try:
-                session['site'] = site
-            except Exception as e:
-                cloud_logger.info(f"Unable to store site locally.")
-            
-            # Return book options to front end for user to choose
-            return jsonify({'bookOptions': bookOptions})
+    # Query every known site at once and merge whatever answers in time
+    bookOptions, bookSites = searchSites(bookDict)
+    for book in bookOptions:
+        cloud_logger.info(f"Entry Title: {book}")
 
     if not bookOptions:
         return jsonify({'error': 'No matching books found!'}), 404
 
+    # Cache the book options
+    cloud_logger.info(f"Storing data locally")
+    try:
+        session['bookOptions'] = bookOptions
+        session['bookSites'] = bookSites
+        session['bookDict'] = bookDict
+    except Exception as e:
+        cloud_logger.info(f"Unable to store book options locally: {e}")
+
+    # Return book options to front end for user to choose
+    return jsonify({'bookOptions': bookOptions})
+
+# Streaming variant of the first route: emits each site's options as NDJSON as soon as they are parsed
+@app.route('/scrape/stream', methods=['POST'])
+def streamBookOptions():
+    data = request.json
+    cloud_logger.info(f"Received data: {data}")
+    bookDict = {'title': data.get('title'), 'author': data.get('author')}
+
+    # Start a fresh result set so a selection made mid-stream resolves against this search
+    session['bookDict'] = bookDict
+    session['bookOptions'] = {}
+    session['bookSites'] = {}
+
+    def generate():
+        bookOptions = {}
+        bookSites = {}
+        answered = []
+        for site, siteOptions in iterSiteOptions(bookDict):
+            newOptions = mergeSiteOptions(bookOptions, bookSites, site, siteOptions)
+            answered.append(site)
+            if not newOptions:
+                continue
+
+            saveSession(bookDict, {'bookOptions': bookOptions, 'bookSites': bookSites})
+            yield json.dumps({'site': site, 'bookOptions': newOptions}) + '\n'
+
+        summary = {'done': True, 'count': len(bookOptions), 'sites': answered}
+        if not bookOptions:
+            summary['error'] = 'No matching books found!'
+        yield json.dumps(summary) + '\n'
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Stop proxies from holding results back
+    return response
+
 # Second route: Accept user's book selection and scrape audio
 @app.route('/scrape/continue', methods=['POST'])
 def scrapeAudio():
@@ -138,8 +229,7 @@ def scrapeAudio():
         cloud_logger.info(f"book options: {bookOptions}")
         bookDict = session.get('bookDict')
         cloud_logger.info(f"bookDict: {bookDict}")
-        site = session.get('site')
-        cloud_logger.info(f"Site: {site}")
+        bookSites = session.get('bookSites') or {}
 
         if not bookOptions or not bookDict:
             cloud_logger.info("Local storage error")
@@ -148,6 +238,14 @@ def scrapeAudio():
         # return audio files to front end
         audioFiles = chooseBook(bookOptions, selected_book_index)
         session['audioFiles'] = audioFiles
+        session['bookEntry'] = chooseTitle(bookOptions, selected_book_index)
+        session['site'] = bookSites.get(session['bookEntry'])
+        cloud_logger.info(f"Site: {session['site']}")
+
+        # Start warming the chapter cache before the user clicks Download
+        if audioFiles:
+            sid = session.sid
+            chapterPrefetcher.start(sid, audioFiles, lambda: sessionAlive(sid))
         
         # cloud_logger.info session data for debugging
         cloud_logger.info(f"Session Audio Files: {session['audioFiles']}")
@@ -176,107 +274,499 @@ def download_audio():
         if not bookDict or not audioFiles:
             return jsonify({'error': 'Audio files or bookDict missing from session'}), 400
 
-        # Create a zip file in memory
-        zip_buffer = BytesIO()
-
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for index, file_url in audioFiles.items():
-                # download each audio file
-                cloud_logger.info(f"Attempting to download file at URL: {file_url}")
-                response = requests.get(file_url)
-                if response.status_code != 200:
-                    return jsonify({'error': f'Failed to download audio file {index}'}), 500
-
-                # Add downloaded content to ZIP
-                zip_file.writestr(f"{bookDict['title']}_{index}.mp3", response.content)
+        download_name = f"{bookDict['title']}_audiobook.zip"
+        archive_key = sessionArchiveKey()
+
+        pace = egressPacer()
+        cached = sendCachedArchive(archive_key, download_name, pace)
+        if cached:
+            return cached
+
+        # With every chapter already cached the archive is served straight from them
+        virtual = openVirtualArchive(bookDict['title'], audioFiles)
+        if virtual:
+            cloud_logger.info(f"Serving virtual archive over {len(audioFiles)} cached chapters")
+            return delivery.sendVirtual(virtual, download_name, 'application/zip', pace)
+
+        # Check every chapter link up front, so a dead one is reported before a long download
+        sizes, dead = probeBook(audioFiles)
+        if dead:
+            return jsonify({'error': f'Audio file {dead[0]} is no longer available', 'deadChapters': dead}), 500
+
+        # Start fetching chapters and hold the response until the first one answers,
+        # so an upstream failure can still be reported before any bytes are sent
+        stream = chapters.iterChapters(audioFiles, cache=contentCache, owner=bandwidthOwner())
+        first = next(stream)
+        if not first[2].waitForStatus():
+            stream.close()
+            return jsonify({'error': f'Failed to download audio file {first[0]}'}), 500
+
+        # Stream the ZIP to the client as chapter bytes arrive. The chapters land in the cache
+        # on the way, so the next download of this book is served from them without an archive copy.
+        zipped, archive_size = buildArchive(bookDict['title'], first, stream, sizes)
+        if archive_size is None and wantsWholeArchive():
+            # No exact size to stream against, so build it all first for clients that need one
+            spool, archive_size = spoolArchive(zipped)
+            zipped = delivery.iterFile(spool, 0, archive_size)
+        response = Response(pace(zipped) if pace else zipped, mimetype='application/zip')
+        response.content_length = archive_size  # Exact when every chapter's size was probed
+        response.headers.set('Content-Disposition', 'attachment', **delivery.attachmentFilename(download_name))
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
 
-        # Ensure the ZIP buffer is set at the beginning of the stream
-        zip_buffer.seek(0)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        # Send the ZIP file as a downloadable attachment
-        return send_file(zip_buffer, download_name=f"{bookDict['title']}_audiobook.zip", as_attachment=True)
+# Stream one chapter for listening straight away, seekable through Range, filling the cache on the way.
+# The book is the session's selection, or that of the download job named by ?job=<id>.
+@app.route('/chapter/<int:index>', methods=['GET'])
+def streamChapter(index):
+    jobId = request.args.get('job')
+    if jobId:
+        job = downloadJobs.load(jobId)
+        if not job or 'audioFiles' not in job:
+            return jsonify({'error': 'No such download job'}), 404
+        title, audioFiles = job['title'], dict(job['audioFiles'])
+    else:
+        bookDict = session.get('bookDict')
+        audioFiles = session.get('audioFiles')
+        if not bookDict or not audioFiles:
+            return jsonify({'error': 'Audio files or bookDict missing from session'}), 400
+        title = bookDict['title']
+
+    url = audioFiles.get(index) or audioFiles.get(str(index))
+    if not url:
+        return jsonify({'error': f'No audio file {index}'}), 404
+    name = chapterFileName(title, index)
+    pace = egressPacer()
+
+    cached = contentCache.open(cache.CHAPTERS, cache.chapterKey(url))
+    if cached:
+        return delivery.sendFile(cached, name, 'audio/mpeg', pace, disposition='inline')
+
+    # Cache the whole chapter in the background, whatever part of it this request wants
+    owner = bandwidthOwner()
+    filler, fetch = chapters.openChapter(url, contentCache, owner)
+    if fetch:
+        chapters.getExecutor().submit(chapters.fetchAndRelease, filler)
+    else:
+        chapters.releaseChapter(filler)
+
+    # Follow the fill as it lands rather than fetching the chapter twice
+    buffer, fetch = chapters.openChapter(url, contentCache, owner)
+    if fetch:
+        chapters.getExecutor().submit(chapters.fetchChapter, buffer)
+    if not buffer.waitForStatus():
+        chapters.releaseChapter(buffer)
+        return jsonify({'error': f'Failed to download audio file {index}'}), 502
+
+    span = bufferedSpan(buffer)
+    if span is False:
+        # A seek past what has arrived so far goes straight to upstream
+        chapters.releaseChapter(buffer)
+        return proxyChapterRange(url, name, owner, pace)
+    start, stop = span or (0, None)
+
+    def generate():
+        try:
+            yield from buffer.iterChunks(start=start, stop=stop)
+        finally:
+            chapters.releaseChapter(buffer)
+
+    if span:
+        response = Response(pace(generate()) if pace else generate(), 206, mimetype='audio/mpeg')
+        response.content_length = stop - start
+        response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{buffer.contentLength}"
+    else:
+        response = Response(pace(generate()) if pace else generate(), mimetype='audio/mpeg')
+        response.content_length = buffer.contentLength
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers.set('Content-Disposition', 'inline', **delivery.attachmentFilename(name))
+    return response
+
+def bufferedSpan(buffer):
+    # (start, stop) of the requested range if the chapter's fill already reaches its start,
+    # None to answer with the whole chapter, or False to pass the range through to upstream.
+    # Browsers open media with bytes=0-, which the fill can always serve.
+    byteRange = request.range
+    if byteRange is None or len(byteRange.ranges) != 1:
+        return None
+    if buffer.contentLength is None:
+        return None if byteRange.ranges[0] == (0, None) else False
+    span = byteRange.range_for_length(buffer.contentLength)
+    if span is None or span[0] > buffer.size:
+        return False
+    return span
+
+def proxyChapterRange(url, name, owner, pace):
+    # Pass a seek straight through to upstream while the cache fill catches up
+    headers = {'Range': request.headers['Range'], 'Accept-Encoding': 'identity'}
+    upstreamResponse = upstream.get(url, stream=True, headers=headers)
+    if upstreamResponse.status_code not in (200, 206, 416):
+        upstreamResponse.close()
+        return jsonify({'error': f'Upstream answered {upstreamResponse.status_code}'}), 502
+
+    def generate():
+        with upstreamResponse:
+            chunks = upstreamResponse.iter_content(chunk_size=chapters.CHUNK_SIZE)
+            yield from bandwidth.ingress.throttle(owner, chunks)
+
+    # Upstream's validators are left out, since If-Range against them would not match ours
+    response = Response(pace(generate()) if pace else generate(), upstreamResponse.status_code, mimetype='audio/mpeg')
+    for header in ('Content-Length', 'Content-Range'):
+        if header in upstreamResponse.headers:
+            response.headers[header] = upstreamResponse.headers[header]
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers.set('Content-Disposition', 'inline', **delivery.attachmentFilename(name))
+    return response
+
+# Background download: start a job for the session's book and return its id straight away
+@app.route('/download_jobs', methods=['POST'])
+def startDownloadJob():
+    bookDict = session.get('bookDict')
+    audioFiles = session.get('audioFiles')
+    if not bookDict or not audioFiles:
+        return jsonify({'error': 'Audio files or bookDict missing from session'}), 400
+
+    archive_key = sessionArchiveKey()
+    job = downloadJobs.create(
+        archiveKey=archive_key,
+        downloadName=f"{bookDict['title']}_audiobook.zip",
+        title=bookDict['title'],
+        audioFiles=list(audioFiles.items()),
+        chapters=len(audioFiles),
+    )
+    cloud_logger.info(f"Created download job {job['id']}")
+
+    if archiveAvailable(archive_key):
+        job['status'] = jobs.DONE
+        downloadJobs.save(job)
+    else:
+        owner = bandwidthOwner()
+        downloadJobs.submit(job, lambda progress: assembleArchive(bookDict['title'], audioFiles, archive_key, progress, owner))
+    return jsonify(jobStatus(job)), 202
+
+# Progress of a background download
+@app.route('/download_jobs/<job_id>', methods=['GET'])
+def downloadJobStatus(job_id):
+    job = downloadJobs.load(job_id)
+    if not job:
+        return jsonify({'error': 'No such download job'}), 404
+    return jsonify(jobStatus(job))
+
+# Finished archive of a background download
+@app.route('/download_jobs/<job_id>/file', methods=['GET'])
+def downloadJobFile(job_id):
+    job = downloadJobs.load(job_id)
+    if not job:
+        return jsonify({'error': 'No such download job'}), 404
+    if job['status'] != jobs.DONE:
+        return jsonify(jobStatus(job)), 409
+
+    pace = egressPacer()
+    cached = sendCachedArchive(job['archiveKey'], job['downloadName'], pace)
+    if cached:
+        return cached
+
+    # The archive itself was evicted, but its chapters may all still be here
+    virtual = openVirtualArchive(job['title'], dict(job['audioFiles'])) if 'audioFiles' in job else None
+    if not virtual:
+        return jsonify({'error': 'Archive has expired, please start the download again'}), 410
+    return delivery.sendVirtual(virtual, job['downloadName'], 'application/zip', pace)
+
+def jobStatus(job):
+    status = {key: job[key] for key in ('id', 'status', 'chapter', 'chapters', 'bytesDone', 'bytesTotal', 'error')}
+    if job['status'] == jobs.DONE:
+        status['fileUrl'] = f"/download_jobs/{job['id']}/file"
+    return status
+
+def sessionArchiveKey():
+    return cache.archiveKey(session.get('site'), session.get('bookEntry'), session['bookDict']['title'], session['audioFiles'])
+
+def archiveAvailable(archive_key):
+    if contentStore and contentStore.has(cache.ARCHIVES, archive_key):
+        return True
+    return contentCache.lookup(cache.ARCHIVES, archive_key) is not None
+
+def sendCachedArchive(archive_key, download_name, pace=None):
+    # Response for an already assembled archive, or None if it has to be built
+
+    # Send the client to the object store when it already holds this archive
+    if contentStore and contentStore.has(cache.ARCHIVES, archive_key):
+        cloud_logger.info(f"Redirecting to stored archive {archive_key}")
+        return redirect(contentStore.signedUrl(cache.ARCHIVES, archive_key, download_name, 'application/zip'))
+
+    # Serve a previously assembled archive straight from disk, resumable with Range
+    archive_file = contentCache.open(cache.ARCHIVES, archive_key)
+    if archive_file:
+        cloud_logger.info(f"Serving cached archive {archive_key}")
+        return delivery.sendFile(archive_file, download_name, 'application/zip', pace)
+    return None
+
+def assembleArchive(title, audioFiles, archive_key, progress, owner=None):
+    # Build the archive straight into the cache, for a background job
+    sizes, dead = probeBook(audioFiles)
+    if dead:
+        raise IOError(f'Audio file {dead[0]} is no longer available')
+    progress.setLengths(sizes)
+    stream = chapters.iterChapters(audioFiles, cache=contentCache, owner=owner, weight=bandwidth.JOB_WEIGHT)
+    zipped, archive_size = buildArchive(title, next(stream), stream, sizes, progress)
+    for data in contentCache.tee(cache.ARCHIVES, archive_key, zipped):
+        pass
+
+def openVirtualArchive(title, audioFiles):
+    # archive.VirtualZip over the cached chapters, or None unless every chapter is cached here
+    entries = []
+    for index, url in audioFiles.items():
+        file = contentCache.open(cache.CHAPTERS, cache.chapterKey(url))
+        if not file:
+            for name, opened, crc in entries:
+                opened.close()
+            return None
+        entries.append((chapterFileName(title, index), file, contentCache.checksum(file)))
+    return archive.VirtualZip(entries)
+
+def probeBook(audioFiles):
+    # ({index: size or None}, [dead chapter indexes]) from probing every chapter at once
+    probes = chapters.probeChapters(audioFiles, cache=contentCache)
+    dead = [index for index, probe in probes.items() if probe.dead]
+    if dead:
+        cloud_logger.info(f"Dead chapter links: {[probes[index].url for index in dead]}")
+    return {index: probe.size for index, probe in probes.items()}, dead
+
+def buildArchive(title, first, stream, sizes, progress=None):
+    # (archive chunks, exact archive size or None). Knowing every chapter's size lets the
+    # archive store them all, which fixes its layout and so its length before it is written.
+    entries = chapterEntries(title, first, stream, progress, sizes)
+    if None in sizes.values():
+        return archive.streamZip(entries), None
+    layout = [(chapterFileName(title, index), size) for index, size in sizes.items()]
+    return archive.streamZip(entries, archive.storeAll), archive.storedZipSize(layout)
+
+def wantsWholeArchive():
+    # HTTP/1.0 clients and proxies cannot take a stream of unknown length; others can opt in
+    return request.args.get('buffered') == '1' or request.environ.get('SERVER_PROTOCOL') == 'HTTP/1.0'
+
+def spoolArchive(zipped):
+    # (file, size) holding the whole archive, in memory up to ARCHIVE_SPOOL_BYTES and in an
+    # anonymous temp file past that, so a large book never has to fit in the worker's memory.
+    # The temp file has no name, so closing it, or the worker dying, frees the disk space.
+    spool = tempfile.SpooledTemporaryFile(max_size=app.config['ARCHIVE_SPOOL_BYTES'], dir=app.config['ARCHIVE_SPOOL_DIR'])
+    try:
+        for data in zipped:
+            spool.write(data)
+    except BaseException:
+        spool.close()
+        raise
+    return spool, spool.tell()
+
+def chapterFileName(title, index):
+    return f"{title}_{index}.mp3"
+
+def chapterEntries(title, first, stream, progress=None, sizes=None):
+    # Archive entries for streamZip, one per chapter in order. A chapter with a probed
+    # size must come out exactly that long, since the archive's length depends on it.
+    try:
+        for index, file_url, buffer in itertools.chain([first], stream):
+            if not buffer.waitForStatus():
+                cloud_logger.info(f"Failed to download audio file {index}, aborting archive")
+                raise IOError(f'Failed to download audio file {index}')
+            size = sizes.get(index) if sizes else None
+            if size is None:
+                size = buffer.contentLength
+            elif buffer.contentLength not in (None, size):
+                raise IOError(f'Audio file {index} changed size since it was checked')
+            chunks = checkedLength(buffer.iterChunks(), size, index)
+            if progress:
+                progress.startChapter(index, size)
+                chunks = progress.track(chunks)
+            yield chapterFileName(title, index), chunks, size
+    finally:
+        stream.close()
+
+def checkedLength(chunks, size, index):
+    # Pass a chapter's chunks through, failing if it does not add up to size (when known)
+    received = 0
+    for chunk in chunks:
+        received += len(chunk)
+        if size is not None and received > size:
+            raise IOError(f'Audio file {index} is longer than expected')
+        yield chunk
+    if size is not None and received != size:
+        raise IOError(f'Audio file {index} is shorter than expected')
+
+# Local stand-in for object store signed URLs, used when OBJECT_STORE is 'local'
+@app.route('/objects/<token>', methods=['GET'])
+def storedObject(token):
+    if not isinstance(contentStore, objectstore.LocalStore):
+        return jsonify({'error': 'Not found'}), 404
+    resolved = contentStore.resolve(token)
+    if not resolved:
+        return jsonify({'error': 'Link expired or invalid'}), 403
+    path, download_name, content_type = resolved
+    try:
+        return delivery.sendFile(open(path, 'rb'), download_name, content_type, egressPacer())
+    except FileNotFoundError:
+        return jsonify({'error': 'Not found'}), 404
+
+# Current bandwidth allocations, for monitoring
+@app.route('/metrics/bandwidth', methods=['GET'])
+def bandwidthMetrics():
+    return jsonify({'ingress': bandwidth.ingress.snapshot(), 'egress': bandwidth.egress.snapshot()})
+
+def bandwidthOwner():
+    # Who a transfer counts against: the session, or the client's address without one
+    return getattr(session, 'sid', None) or request.remote_addr
+
+def egressPacer():
+    # pace() for a response body at this client's share of the egress ceiling, or None if unlimited
+    if not bandwidth.egress.rate:
+        return None
+    owner = bandwidthOwner()
+    return lambda chunks: bandwidth.egress.throttle(owner, chunks)
+
+def getSiteTimeout(site):
+    timeout = knownSites[site].spec.search_timeout
+    return app.config['SEARCH_SITE_TIMEOUT'] if timeout is None else timeout
+
+def searchSite(site, bookDict, timeout):
+    # Cached results when there are any, so a repeated search does not wait on the site
+    return searchCache.get(site, bookDict, lambda: querySite(site, bookDict, timeout))
+
+def querySite(site, bookDict, timeout):
+    cloud_logger.info(f"Calling getQueryUrl with {bookDict}")
+    queryUrl = getQueryUrl(site, bookDict)
+    cloud_logger.info(f"Query URL: {queryUrl}")
+    # Identical searches running at the same time, here or in another worker, share one fetch
+    return searchCache.coalesce(site, queryUrl, lambda: parseSite(site, queryUrl, bookDict, timeout), timeout)
+
+def parseSite(site, queryUrl, bookDict, timeout):
+    soup = cookSoup(queryUrl, timeout=timeout, parseOnly=knownSites[site].strainer)
+    if soup is None:
+        return None
+    # {} is a real miss; None means the page did not have the layout we expected
+    return getBookOptions(soup, bookDict, site)
+
+def iterSiteOptions(bookDict):
+    # Search all sites at once, yielding (site, bookOptions) as each one answers
+    start = time.monotonic()
+    pending = []
+    for site in siteNames:
+        if searchCache.isMiss(site, bookDict):
+            cloud_logger.info(f"Skipping {site}, it recently found nothing for this search")
+            yield site, {}
+        else:
+            pending.append(site)
+    deadlines = {site: getSiteTimeout(site) for site in pending}
+    budget = min(app.config['SEARCH_BUDGET'], max(deadlines.values(), default=0))
+    futures = {searchExecutor.submit(searchSite, site, bookDict, deadlines[site]): site for site in pending}
 
+    try:
+        for future in as_completed(futures, timeout=budget):
+            site = futures[future]
+            elapsed = time.monotonic() - start
+            if elapsed > deadlines[site]:
+                cloud_logger.info(f"Dropping late answer from {site} after {elapsed:.2f}s")
+                continue
+            try:
+                bookOptions = future.result()
+            except Exception as e:
+                cloud_logger.info(f"Error searching {site}: {e}")
+                continue
+            cloud_logger.info(f"{site} answered in {elapsed:.2f}s with {len(bookOptions)} options")
+            yield site, bookOptions
+    except FuturesTimeoutError:
+        for future, site in futures.items():
+            if not future.done():
+                future.cancel()
+                cloud_logger.info(f"{site} missed the {budget}s search budget")
+
+def mergeSiteOptions(bookOptions, bookSites, site, siteOptions):
+    # Keep the first site to answer for a duplicate title, returning only the new options
+    newOptions = {}
+    for title, audioUrlDict in siteOptions.items():
+        if title not in bookOptions:
+            bookOptions[title] = audioUrlDict
+            bookSites[title] = site
+            newOptions[title] = audioUrlDict
+    return newOptions
+
+def searchSites(bookDict):
+    bookOptions = {}
+    bookSites = {}
+    for site, siteOptions in iterSiteOptions(bookDict):
+        mergeSiteOptions(bookOptions, bookSites, site, siteOptions)
+    return bookOptions, bookSites
+
+def sessionAlive(sid):
+    # True while the server-side session store still holds this session
+    interface = app.session_interface
+    return interface._retrieve_session_data(interface._get_store_id(sid)) is not None
+
+def saveSession(bookDict, updates):
+    # Streamed responses have already passed after_request, so write the session store directly.
+    # Other requests may have changed the session since this one began, such as a selection
+    # made mid-stream, so updates are merged into the stored session rather than overwriting
+    # it, and dropped altogether once a newer search has replaced this one.
+    interface = app.session_interface
+    sid = session.sid
+    try:
+        stored = interface._retrieve_session_data(interface._get_store_id(sid))
+        if stored is None or stored.get('bookDict') != bookDict:
+            return
+        merged = interface.session_class(stored, sid=sid)
+        merged.update(updates)
+        interface.save_session(app, merged, Response())
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        cloud_logger.info(f"Unable to save session mid-stream: {e}")
 
 def getQueryUrl(site, queryDict):
     try:
-        queryTitle = queryDict.get('title').strip().replace(' ','+')
-        if queryDict.get('author'):
-            queryAuthor = queryDict.get('author').strip().replace(' ','+')
-            query = queryTitle + '+' + queryAuthor      
-        query = queryTitle
-        siteDict = knownSitesJson.get(site)
-        searchUrl = siteDict.get('search_url')
-        queryUrl = searchUrl + query
-        return queryUrl
+        return knownSites[site].queryUrl(queryDict.get('title'))
     except Exception as e:
         cloud_logger.info(f"Error in main function getQueryUrl: {e}")
 
 def getBookOptions(soup, bookDict, site):
-    # Site navigation information
-    navigation = knownSitesJson.get(site).get("html_navigation")
-    section_tag = navigation.get("query_results_section")
-    section_id = navigation.get("query_results_id")
-    entry_tag = navigation.get("entry")
-    entry_title_tag = navigation.get("entry_title")
-    audio_tag = navigation.get("audio_tag")
-    audio_file_tag = navigation.get("file_tag")
-
     cloud_logger.info(f"Getting book options for {site}")
     try:
-        bookOptions = {}
-        userTitle = bookDict.get('title').lower()
-        entries = soup.find(section_tag, id=section_id).find_all(entry_tag)
-        for entry in entries:
-            title = entry.find(entry_title_tag).text
-            cleanTitle = title.strip().lower()
-            if userTitle in cleanTitle:
-                audioUrlDict= scrapeAudio(entry, audio_tag)
-                bookOptions[title] = audioUrlDict
+        bookOptions = knownSites[site].bookOptions(soup, bookDict.get('title'))
+        if bookOptions is None:
+            cloud_logger.info(f"No results section on the {site} search page")
         return bookOptions
-    
+
     except Exception as e:
         cloud_logger.info(f"Error in main function getBookOptions: {e}")
 
-def chooseBook(options, selection_index):
+def chooseTitle(options, selection_index):
     try:
         titleOptions = list(options.keys())
-        selected_title = titleOptions[selection_index - 1]
-        cloud_logger.info(f"Selected Option: {selected_title}")
-        return options[selected_title]
+        return titleOptions[selection_index - 1]
     except Exception as e:
-        cloud_logger.info(f"Error in main function chooseBook: {e}")
+        cloud_logger.info(f"Error in main function chooseTitle: {e}")
 
-def scrapeAudio(entry, audio_tag):
+def chooseBook(options, selection_index):
     try:
-        audioUrls= {}
-        audio_section = entry.find_all(audio_tag)
-
-        count = 1
-        for audio in audio_section:
-            url = audio.get('src')
-            if not url:
-                
-                source = audio.find('source')
-                url = source['src'] if source and source.has_attr('src') else None
-            audioUrls[count] = url
-            count += 1
-        return audioUrls
-    
+        selected_title = chooseTitle(options, selection_index)
+        cloud_logger.info(f"Selected Option: {selected_title}")
+        return options[selected_title]
     except Exception as e:
-        cloud_logger.info(f"Error in main function scrapeAudio: {e}")
+        cloud_logger.info(f"Error in main function chooseBook: {e}")
 
-def cookSoup(url):
+def cookSoup(url, timeout=10, parseOnly=None):
     cloud_logger.info(f"Cooking soup with url: {url}")
     try:
-        response = requests.get(url, timeout=10)
+        response = upstream.get(url, timeout=timeout)
         if response.status_code == 200:
             try:
                 cloud_logger.info("Attempting to parse with BeautifulSoup...")
-                soup = BeautifulSoup(response.text, 'html.parser')
+                soup = BeautifulSoup(response.text, 'html.parser', parse_only=parseOnly)
                 if not soup or len(soup) == 0:
                     cloud_logger.error("Soup object is empty or None. The page might be malformed.")
+                elif parseOnly is not None:
+                    # Only the part of the page matching parseOnly was built, so there is no title
+                    return soup
                 else:
                     # Optionally, check for specific tags
                     title_tag = soup.find('title')
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import struct
+import zipfile
+import hashlib
+import itertools
+
+class StreamSink:
+    # Write-only, unseekable file for zipfile: it switches zipfile to data descriptors and
+    # lets the generator below hand each piece of the archive to the client as it is written
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+# Leading bytes of formats that are already compressed, so DEFLATE would only burn CPU
+COMPRESSED_SIGNATURES = (
+    b'ID3',  # MP3 with ID3v2 tag
+    b'OggS',  # Ogg Vorbis / Opus
+    b'fLaC',  # FLAC
+    b'\xff\xd8\xff',  # JPEG cover art
+    b'\x89PNG',  # PNG cover art
+    b'PK\x03\x04',  # Nested ZIP
+)
+
+def isAlreadyCompressed(head):
+    if head.startswith(COMPRESSED_SIGNATURES):
+        return True
+    # Bare MPEG audio frame sync (MP3 / AAC ADTS without a tag)
+    if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        return True
+    # MP4 / M4A / M4B containers
+    return head[4:8] == b'ftyp'
+
+def chooseCompression(name, head):
+    # Store what is already compressed, deflate text and metadata sidecars
+    if isAlreadyCompressed(head):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def storeAll(name, head):
+    # Policy for archives whose size must be known before they are written
+    return zipfile.ZIP_STORED
+
+def storedZipSize(entries):
+    # Exact length of what streamZip writes for (name, size) entries under storeAll,
+    # following zipfile's own rules for when each record needs its Zip64 form
+    offset = 0
+    directory = 0
+    for name, size in entries:
+        try:
+            nameLength = len(name.encode('ascii'))
+        except UnicodeEncodeError:
+            nameLength = len(name.encode('utf-8'))
+        headerOffset = offset
+
+        # Local header, data, then the data descriptor for an unseekable archive
+        zip64 = size * 1.05 > zipfile.ZIP64_LIMIT
+        offset += zipfile.sizeFileHeader + nameLength + (20 if zip64 else 0)
+        offset += size + (24 if zip64 else 16)
+
+        # Central directory record, with 8 bytes per field too big for its 32-bit slot
+        large = 2 * (size > zipfile.ZIP64_LIMIT) + (headerOffset > zipfile.ZIP64_LIMIT)
+        directory += zipfile.sizeCentralDir + nameLength + (4 + 8 * large if large else 0)
+
+    end = zipfile.sizeEndCentDir
+    if len(entries) > zipfile.ZIP_FILECOUNT_LIMIT or offset > zipfile.ZIP64_LIMIT or directory > zipfile.ZIP64_LIMIT:
+        end += zipfile.sizeEndCentDir64 + zipfile.sizeEndCentDir64Locator
+    return offset + directory + end
+
+def entryInfo(name, size=None, compression=zipfile.ZIP_DEFLATED, date_time=None):
+    zinfo = zipfile.ZipInfo(name, date_time or time.localtime()[:6])
+    zinfo.compress_type = compression
+    zinfo.external_attr = 0o644 << 16
+    if size is not None:
+        zinfo.file_size = size  # Lets zipfile decide up front whether the entry needs Zip64
+    return zinfo
+
+def streamZip(entries, policy=chooseCompression):
+    # entries yields (name, chunks, size) with size None when unknown; yields archive bytes.
+    # policy picks each entry's compression method from its name and first chunk.
+    sink = StreamSink()
+    with zipfile.ZipFile(sink, 'w') as zip_file:
+        for name, chunks, size in entries:
+            chunks = iter(chunks)
+            head = next(chunks, b'')
+            zinfo = entryInfo(name, size, policy(name, head))
+            with zip_file.open(zinfo, 'w', force_zip64=size is None) as entry:
+                for chunk in itertools.chain([head], chunks):
+                    entry.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            yield sink.drain()
+    # Central directory, plus the Zip64 end records once the archive passes 4 GiB
+    yield sink.drain()
+
+READ_SIZE = 64 * 1024  # Bytes read from a chapter file at a time when serving a virtual archive
+
+class VirtualZip:
+    # Stored-mode ZIP laid out over open files whose CRC-32s are already known. Nothing is
+    # written anywhere: the headers are generated up front and any byte range of the archive
+    # is read from them and the files, so repeat and ranged downloads cost no extra disk.
+    def __init__(self, entries):
+        # entries are (name, open file, crc) in archive order
+        self.files = []
+        self.pieces = []  # (archive offset, length, bytes or (file, file offset))
+        self.size = 0
+        records = []
+        identity = []
+        for name, file, crc in entries:
+            self.files.append(file)
+            stat = os.fstat(file.fileno())
+            zinfo = entryInfo(name, stat.st_size, zipfile.ZIP_STORED, time.localtime(stat.st_mtime)[:6])
+            zinfo.CRC = crc
+            zinfo.compress_size = stat.st_size
+            zinfo.header_offset = self.size
+            self.add(zinfo.FileHeader(zinfo.file_size > zipfile.ZIP64_LIMIT))
+            self.add((file, 0), stat.st_size)
+            records.append(centralRecord(zinfo))
+            identity.append([name, stat.st_ino, stat.st_mtime_ns, stat.st_size, crc])
+
+        directoryOffset = self.size
+        for record in records:
+            self.add(record)
+        self.add(endRecords(len(records), self.size - directoryOffset, directoryOffset))
+
+        self.etag = hashlib.sha256(json.dumps(identity).encode('utf-8')).hexdigest()[:32]
+        self.lastModified = max((os.fstat(file.fileno()).st_mtime for file in self.files), default=0)
+
+    def add(self, source, length=None):
+        length = len(source) if length is None else length
+        self.pieces.append((self.size, length, source))
+        self.size += length
+
+    def iterRange(self, start, length):
+        # Archive bytes [start, start + length), closing the files once done
+        try:
+            stop = start + length
+            for offset, size, source in self.pieces:
+                if offset + size <= start or offset >= stop:
+                    continue
+                begin = max(start, offset) - offset
+                end = min(stop, offset + size) - offset
+                if isinstance(source, bytes):
+                    yield source[begin:end]
+                    continue
+                file, fileOffset = source
+                while begin < end:
+                    data = os.pread(file.fileno(), min(READ_SIZE, end - begin), fileOffset + begin)
+                    if not data:
+                        raise IOError(f"{file.name} is shorter than when the archive was laid out")
+                    begin += len(data)
+                    yield data
+        finally:
+            self.close()
+
+    def close(self):
+        for file in self.files:
+            file.close()
+
+def centralRecord(zinfo):
+    # Central directory record for an entry, as zipfile writes it
+    dt = zinfo.date_time
+    dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+    dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+    file_size, compress_size, header_offset = zinfo.file_size, zinfo.compress_size, zinfo.header_offset
+    extra = []
+    if zinfo.file_size > zipfile.ZIP64_LIMIT:
+        extra += [zinfo.file_size, zinfo.compress_size]
+        file_size = compress_size = 0xffffffff
+    if zinfo.header_offset > zipfile.ZIP64_LIMIT:
+        extra.append(zinfo.header_offset)
+        header_offset = 0xffffffff
+    extra_data = struct.pack('<HH' + 'Q' * len(extra), 1, 8 * len(extra), *extra) if extra else b''
+    version = max(zipfile.ZIP64_VERSION if extra else 0, zinfo.extract_version)
+    try:
+        filename, flag_bits = zinfo.filename.encode('ascii'), zinfo.flag_bits
+    except UnicodeEncodeError:
+        filename, flag_bits = zinfo.filename.encode('utf-8'), zinfo.flag_bits | 0x800
+    record = struct.pack(
+        zipfile.structCentralDir, zipfile.stringCentralDir,
+        max(version, zinfo.create_version), zinfo.create_system, version, zinfo.reserved,
+        flag_bits, zinfo.compress_type, dostime, dosdate, zinfo.CRC,
+        compress_size, file_size, len(filename), len(extra_data), 0, 0,
+        zinfo.internal_attr, zinfo.external_attr, header_offset,
+    )
+    return record + filename + extra_data
+
+def endRecords(count, directorySize, directoryOffset):
+    # End of central directory, preceded by the Zip64 end records when the archive needs them
+    records = b''
+    if count > zipfile.ZIP_FILECOUNT_LIMIT or directoryOffset > zipfile.ZIP64_LIMIT or directorySize > zipfile.ZIP64_LIMIT:
+        records += struct.pack(
+            zipfile.structEndArchive64, zipfile.stringEndArchive64,
+            44, 45, 45, 0, 0, count, count, directorySize, directoryOffset,
+        )
+        records += struct.pack(
+            zipfile.structEndArchive64Locator, zipfile.stringEndArchive64Locator,
+            0, directoryOffset + directorySize, 1,
+        )
+        count = min(count, 0xFFFF)
+        directorySize = min(directorySize, 0xFFFFFFFF)
+        directoryOffset = min(directoryOffset, 0xFFFFFFFF)
+    records += struct.pack(
+        zipfile.structEndArchive, zipfile.stringEndArchive,
+        0, 0, count, count, directorySize, directoryOffset, 0,
+    )
+    return records
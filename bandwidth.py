@@ -0,0 +1,121 @@
+import time
+import hashlib
+import threading
+
+# Bandwidth shaping defaults; app.py sets the real ceilings from its config. Buckets live in
+# one process, so these are per gunicorn worker; app.py gives each worker its slice of the VM's.
+INGRESS_RATE = None  # Bytes per second this worker's chapter downloads may pull from upstream; None is unlimited
+EGRESS_RATE = None  # Bytes per second this worker's responses may send to clients; None is unlimited
+BURST_SECONDS = 0.5  # How far ahead of its rate a bucket may run, in seconds of traffic
+
+# Relative shares of whoever is moving data at the time
+INTERACTIVE_WEIGHT = 1.0  # A user waiting on a download in the browser
+JOB_WEIGHT = 0.5  # A background download job
+PREFETCH_WEIGHT = 0.25  # Speculative prefetch of a book nobody has asked to download yet
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 0
+        self.stamp = time.monotonic()
+
+    def take(self, nbytes, now):
+        # Seconds to wait before sending nbytes. Tokens may go negative, so a large
+        # chunk is paid for by waiting rather than by never being allowed through.
+        if not self.rate:
+            return 0
+        burst = self.rate * BURST_SECONDS
+        self.tokens = min(burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= nbytes
+        return max(0, -self.tokens / self.rate)
+
+class Owner:
+    # Everything one session or IP address has moving in one direction
+    def __init__(self):
+        self.flows = 0
+        self.weights = []
+        self.bucket = TokenBucket(None)
+        self.bytes = 0
+
+    def weight(self):
+        return max(self.weights)
+
+class BandwidthManager:
+    # Token buckets pacing one direction of traffic: a global ceiling, shared between the
+    # owners moving data at the moment in proportion to their weights. An owner's share is
+    # recomputed whenever someone starts or stops, so one user's 50-chapter book leaves
+    # everyone else the same slice it gets.
+    def __init__(self, name, rate=None):
+        self.name = name
+        self.rate = rate
+        self.total = TokenBucket(rate)
+        self.owners = {}
+        self.lock = threading.Lock()
+
+    def setRate(self, rate):
+        with self.lock:
+            self.rate = self.total.rate = rate
+            self.rebalance()
+
+    def open(self, owner, weight=INTERACTIVE_WEIGHT):
+        with self.lock:
+            state = self.owners.setdefault(owner, Owner())
+            state.flows += 1
+            state.weights.append(weight)
+            self.rebalance()
+
+    def close(self, owner, weight=INTERACTIVE_WEIGHT):
+        with self.lock:
+            state = self.owners[owner]
+            state.flows -= 1
+            state.weights.remove(weight)
+            if not state.flows:
+                del self.owners[owner]
+            self.rebalance()
+
+    def rebalance(self):
+        # Caller holds lock
+        totalWeight = sum(state.weight() for state in self.owners.values())
+        for state in self.owners.values():
+            state.bucket.rate = self.rate * state.weight() / totalWeight if self.rate else None
+
+    def consume(self, owner, nbytes):
+        # Block until owner may move nbytes more
+        with self.lock:
+            state = self.owners[owner]
+            state.bytes += nbytes
+            now = time.monotonic()
+            delay = max(state.bucket.take(nbytes, now), self.total.take(nbytes, now))
+        if delay:
+            time.sleep(delay)
+
+    def throttle(self, owner, chunks, weight=INTERACTIVE_WEIGHT):
+        # Pass chunks through at owner's share of the bandwidth
+        self.open(owner, weight)
+        try:
+            for chunk in chunks:
+                self.consume(owner, len(chunk))
+                yield chunk
+        finally:
+            self.close(owner, weight)
+
+    def snapshot(self):
+        # Current allocations, with owners reduced to a short hash since they are session ids and IPs
+        with self.lock:
+            return {
+                'rate': self.rate,
+                'owners': [
+                    {
+                        'owner': hashlib.sha256(str(owner).encode('utf-8')).hexdigest()[:12],
+                        'flows': state.flows,
+                        'weight': state.weight(),
+                        'share': state.bucket.rate,
+                        'bytes': state.bytes,
+                    }
+                    for owner, state in self.owners.items()
+                ],
+            }
+
+ingress = BandwidthManager('ingress', INGRESS_RATE)
+egress = BandwidthManager('egress', EGRESS_RATE)
@@ -0,0 +1,69 @@
+# Compare CPU time and archive size for DEFLATE-everything against archive.chooseCompression.
+#
+#   python benchmarks/compressionPolicy.py path/to/chapter1.mp3 path/to/chapter2.mp3 ...
+#   python benchmarks/compressionPolicy.py --synthetic 40 --chapter-mb 12
+#
+# Synthetic chapters are random bytes behind an ID3 header, which compress about as
+# poorly as real MP3 data; pass real chapters for exact numbers.
+import os
+import sys
+import time
+import zipfile
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import archive
+
+CHUNK_SIZE = 64 * 1024
+
+def fileChunks(path):
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+def syntheticChapters(count, chapterBytes):
+    chapter = b'ID3\x04\x00\x00\x00\x00\x00\x00' + os.urandom(chapterBytes)
+    return [(f"chapter_{index}.mp3", chapter) for index in range(1, count + 1)]
+
+def entries(chapters):
+    for name, source in chapters:
+        if isinstance(source, bytes):
+            chunks = (source[offset:offset + CHUNK_SIZE] for offset in range(0, len(source), CHUNK_SIZE))
+            yield name, chunks, len(source)
+        else:
+            yield name, fileChunks(source), os.path.getsize(source)
+
+def run(chapters, policy):
+    start = time.process_time()
+    size = sum(len(data) for data in archive.streamZip(entries(chapters), policy=policy))
+    return time.process_time() - start, size
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare archive compression policies on one book')
+    parser.add_argument('chapters', nargs='*', help='Chapter files making up one book')
+    parser.add_argument('--synthetic', type=int, default=0, help='Generate this many chapters instead')
+    parser.add_argument('--chapter-mb', type=float, default=12, help='Size of each synthetic chapter')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        chapters = syntheticChapters(args.synthetic, int(args.chapter_mb * 1024 * 1024))
+    elif args.chapters:
+        chapters = [(os.path.basename(path), path) for path in args.chapters]
+    else:
+        parser.error('pass chapter files or --synthetic N')
+
+    inputBytes = sum(len(source) if isinstance(source, bytes) else os.path.getsize(source) for name, source in chapters)
+    deflateCpu, deflateSize = run(chapters, lambda name, head: zipfile.ZIP_DEFLATED)
+    policyCpu, policySize = run(chapters, archive.chooseCompression)
+
+    print(f"Book: {len(chapters)} chapters, {inputBytes / 1e6:.1f} MB of audio")
+    print(f"{'':<12}{'CPU s':>10}{'archive MB':>14}")
+    print(f"{'deflate':<12}{deflateCpu:>10.2f}{deflateSize / 1e6:>14.2f}")
+    print(f"{'policy':<12}{policyCpu:>10.2f}{policySize / 1e6:>14.2f}")
+    print(f"CPU saved per book: {deflateCpu - policyCpu:.2f}s, bytes saved by deflate: {(policySize - deflateSize) / 1e6:.2f} MB")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# Compare parsing whole search pages against parsing only the site's results section.
+#
+#   python benchmarks/searchParsing.py --site dailyAudioBooks --title hobbit saved/page1.html saved/page2.html
+#   python benchmarks/searchParsing.py --site dailyAudioBooks --synthetic 20
+#
+# Save pages with e.g. curl 'https://dailyaudiobooks.net/?s=hobbit' > saved/page1.html.
+# Synthetic pages wrap the results in the header, menus, sidebar, footer and scripts
+# a typical WordPress theme sends with them.
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+from bs4 import BeautifulSoup
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import sites
+
+def syntheticPage(plan, results):
+    navigation = plan.spec.html_navigation
+    script = '<script>' + 'var x = {"a": [1, 2, 3], "b": "<div>not markup</div>"};\n' * 200 + '</script>'
+    links = ''.join(f'<li class="menu-item"><a href="/category/{index}/">Category {index}</a></li>' for index in range(300))
+    posts = ''.join(f'<div class="widget"><a href="/post/{index}/"><img src="/thumb/{index}.jpg" alt="Post {index}"></a><span>Post {index}</span></div>' for index in range(150))
+    entries = ''.join(
+        f'<{navigation.entry} class="post"><{navigation.entry_title}>The Hobbit Part {index}</{navigation.entry_title}>'
+        f'<p>Read by someone</p><{navigation.audio_tag} controls><source src="https://example.com/{index}/01.mp3"></{navigation.audio_tag}>'
+        f'<{navigation.audio_tag} src="https://example.com/{index}/02.mp3"></{navigation.audio_tag}></{navigation.entry}>'
+        for index in range(results)
+    )
+    return (
+        f'<!DOCTYPE html><html><head><title>Search results</title>{script * 3}<style>{"body{margin:0}" * 500}</style></head><body>'
+        f'<header><nav><ul>{links}</ul></nav></header><aside id="sidebar">{posts}</aside>'
+        f'<{navigation.query_results_section} id="{navigation.query_results_id}">{entries}</{navigation.query_results_section}>'
+        f'<footer><ul>{links}</ul>{script}</footer></body></html>'
+    )
+
+def run(plan, pages, title, parseOnly, repeat):
+    # CPU seconds per page and peak traced bytes while the largest soup is alive
+    start = time.process_time()
+    for _ in range(repeat):
+        for page in pages:
+            plan.bookOptions(BeautifulSoup(page, 'html.parser', parse_only=parseOnly), title)
+    cpu = (time.process_time() - start) / (repeat * len(pages))
+
+    peak = 0
+    for page in pages:
+        tracemalloc.start()
+        soup = BeautifulSoup(page, 'html.parser', parse_only=parseOnly)
+        options = plan.bookOptions(soup, title)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        del soup
+    return cpu, peak, options
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare whole-page and results-only parsing of search pages')
+    parser.add_argument('pages', nargs='*', help='Saved search result pages from the site')
+    parser.add_argument('--site', required=True, help='Site in knownSites.json whose plan parses the pages')
+    parser.add_argument('--title', default='hobbit', help='Title searched for')
+    parser.add_argument('--synthetic', type=int, default=0, help='Generate one page with this many results instead')
+    parser.add_argument('--repeat', type=int, default=20, help='Times each page is parsed for the CPU figure')
+    args = parser.parse_args()
+
+    plans = sites.loadSites(os.path.join(ROOT, 'knownSites.json'))
+    if args.site not in plans:
+        parser.error(f"{args.site} has no valid plan; sites with one: {', '.join(plans)}")
+    plan = plans[args.site]
+
+    if args.synthetic:
+        pages = [syntheticPage(plan, args.synthetic)]
+    elif args.pages:
+        pages = []
+        for path in args.pages:
+            with open(path, encoding='utf-8', errors='replace') as file:
+                pages.append(file.read())
+    else:
+        parser.error('pass saved pages or --synthetic N')
+
+    title = args.title.strip().lower()
+    fullCpu, fullPeak, fullOptions = run(plan, pages, title, None, args.repeat)
+    strainedCpu, strainedPeak, strainedOptions = run(plan, pages, title, plan.strainer, args.repeat)
+    if fullOptions != strainedOptions:
+        print("Warning: results-only parsing found different options on the last page")
+
+    print(f"Pages: {len(pages)}, {sum(len(page) for page in pages) / 1e3:.0f} kB of HTML, {len(fullOptions or {})} options on the last")
+    print(f"{'':<14}{'ms/page':>10}{'peak MB':>10}")
+    print(f"{'whole page':<14}{fullCpu * 1e3:>10.2f}{fullPeak / 1e6:>10.2f}")
+    print(f"{'results only':<14}{strainedCpu * 1e3:>10.2f}{strainedPeak / 1e6:>10.2f}")
+    print(f"Parse time saved: {(1 - strainedCpu / fullCpu) * 100:.0f}%, peak memory saved: {(1 - strainedPeak / fullPeak) * 100:.0f}%")
+
+if __name__ == '__main__':
+    main()
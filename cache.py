@@ -0,0 +1,219 @@
+import os
+import json
+import fcntl
+import time
+import zlib
+import hashlib
+import tempfile
+import threading
+import logging
+
+cloud_logger = logging.getLogger("cloudLogger")
+
+CHAPTERS = 'chapters'
+ARCHIVES = 'archives'
+CONTENT_TYPES = {CHAPTERS: 'audio/mpeg', ARCHIVES: 'application/zip'}
+STALE_PENDING_SECONDS = 3600  # Partial files older than this were left by a dead worker
+CHECKSUM_ATTR = 'user.crc32'  # Extended attribute holding a cached item's CRC-32
+VALIDATOR_ATTR = 'user.validator'  # Extended attribute holding the upstream ETag a partial item came from
+
+def chapterKey(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+def archiveKey(site, bookEntry, namePrefix, audioFiles):
+    # An archive is only reusable if it came from the same entry, chapter list and file names
+    identity = json.dumps([site, bookEntry, namePrefix, list(audioFiles.values())])
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+class DiskCache:
+    # Chapters and finished archives on local disk, evicted least recently used first
+    # once they pass maxBytes. Recency is the file's atime, so every worker sharing
+    # the directory sees the same order while mtime stays a stable validator for Range.
+    # With an object store, everything committed is also uploaded to it in the background.
+    def __init__(self, root, maxBytes, store=None):
+        self.root = root
+        self.maxBytes = maxBytes
+        self.store = store
+        self.lock = threading.Lock()
+        for kind in (CHAPTERS, ARCHIVES, 'pending'):
+            os.makedirs(os.path.join(root, kind), exist_ok=True)
+        self.clearStalePending()
+
+    def path(self, kind, key):
+        return os.path.join(self.root, kind, key)
+
+    def touch(self, fileOrPath):
+        stat = os.stat(fileOrPath)
+        os.utime(fileOrPath, (time.time(), stat.st_mtime))
+
+    def lookup(self, kind, key):
+        # Path of a cached item, marked as just used, or None
+        path = self.path(kind, key)
+        try:
+            self.touch(path)
+            return path
+        except FileNotFoundError:
+            return None
+
+    def open(self, kind, key):
+        # Open file for a cached item, or None; stays readable even if evicted meanwhile
+        try:
+            file = open(self.path(kind, key), 'rb')
+        except FileNotFoundError:
+            return None
+        self.touch(file.fileno())
+        return file
+
+    def reserve(self):
+        # New partial file, committed under a key once it is complete
+        fd, pendingPath = tempfile.mkstemp(dir=os.path.join(self.root, 'pending'))
+        return os.fdopen(fd, 'w+b'), pendingPath
+
+    def claim(self, kind, key):
+        # Open the partial file every worker uses for key. Returns (file, pendingPath, leader):
+        # the caller fills it only if it got the exclusive lock, otherwise another worker is
+        # filling it and the caller can follow along by reading it.
+        pendingPath = os.path.join(self.root, 'pending', f"{kind}-{key}")
+        while True:
+            fd = os.open(pendingPath, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return os.fdopen(fd, 'r+b'), pendingPath, False
+            # The worker that held the lock may have committed or kept the file between our
+            # open and our lock, in which case we hold a file that is no longer pending
+            if self.isPath(fd, pendingPath):
+                break
+            os.close(fd)
+        os.ftruncate(fd, 0)  # Anything already there was left by a worker that died
+        return os.fdopen(fd, 'r+b'), pendingPath, True
+
+    def isPath(self, fd, path):
+        # True if the open file fd is the one at path now
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        opened = os.fstat(fd)
+        return (stat.st_dev, stat.st_ino) == (opened.st_dev, opened.st_ino)
+
+    def commit(self, kind, key, pendingPath, crc=None):
+        if crc is not None:
+            self.saveChecksum(pendingPath, crc)
+        os.replace(pendingPath, self.path(kind, key))
+        cloud_logger.info(f"Cached {kind} item {key}")
+        if self.store:
+            self.store.uploadLater(kind, key, self.path(kind, key), CONTENT_TYPES[kind])
+        self.evict()
+
+    def partialPath(self, kind, key):
+        return os.path.join(self.root, 'pending', f"partial-{kind}-{key}")
+
+    def keepPartial(self, kind, key, pendingPath, validator):
+        # Set aside an incomplete item so a later download can fetch just the rest of it.
+        # Like any pending file it is cleared once it goes stale.
+        try:
+            os.setxattr(pendingPath, VALIDATOR_ATTR, validator.encode('utf-8'))
+            os.replace(pendingPath, self.partialPath(kind, key))
+            cloud_logger.info(f"Kept {os.path.getsize(self.partialPath(kind, key))} bytes of {kind} item {key} to resume")
+        except OSError:
+            self.discard(pendingPath)
+
+    def takePartial(self, kind, key):
+        # (open file, validator) for a partial item set aside by keepPartial, or None.
+        # Taking it removes it, so only one download ever resumes it.
+        partialPath = self.partialPath(kind, key)
+        takenPath = f"{partialPath}.{os.getpid()}.{threading.get_ident()}"
+        try:
+            os.rename(partialPath, takenPath)
+        except FileNotFoundError:
+            return None
+        try:
+            file = open(takenPath, 'rb')
+            try:
+                return file, os.getxattr(file.fileno(), VALIDATOR_ATTR).decode('utf-8')
+            except OSError:
+                file.close()
+                return None
+        finally:
+            os.unlink(takenPath)
+
+    def checksum(self, file):
+        # CRC-32 of an open cached item, kept with the file so it is only ever worked out once
+        fd = file.fileno()
+        try:
+            return int(os.getxattr(fd, CHECKSUM_ATTR))
+        except (OSError, ValueError):
+            pass
+        crc = 0
+        offset = 0
+        while True:
+            data = os.pread(fd, 1024 * 1024, offset)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            offset += len(data)
+        self.saveChecksum(fd, crc)
+        return crc
+
+    def saveChecksum(self, fileOrPath, crc):
+        try:
+            os.setxattr(fileOrPath, CHECKSUM_ATTR, str(crc).encode('ascii'))
+        except OSError:
+            pass  # No user xattrs on this filesystem, so it is worked out again next time
+
+    def discard(self, pendingPath):
+        try:
+            os.unlink(pendingPath)
+        except FileNotFoundError:
+            pass
+
+    def tee(self, kind, key, chunks):
+        # Pass chunks through while writing them to the cache, keeping them only if the stream completes
+        file, pendingPath = self.reserve()
+        complete = False
+        try:
+            for data in chunks:
+                file.write(data)
+                yield data
+            complete = True
+        finally:
+            file.close()
+            if complete:
+                self.commit(kind, key, pendingPath)
+            else:
+                self.discard(pendingPath)
+
+    def entries(self):
+        for kind in (CHAPTERS, ARCHIVES):
+            with os.scandir(os.path.join(self.root, kind)) as items:
+                for item in items:
+                    try:
+                        stat = item.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield stat.st_atime, stat.st_size, item.path
+
+    def evict(self):
+        with self.lock:
+            entries = sorted(self.entries())
+            total = sum(size for atime, size, path in entries)
+            for atime, size, path in entries:
+                if total <= self.maxBytes:
+                    break
+                try:
+                    os.unlink(path)
+                    cloud_logger.info(f"Evicted {path} ({size} bytes) from cache")
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def clearStalePending(self):
+        cutoff = time.time() - STALE_PENDING_SECONDS
+        with os.scandir(os.path.join(self.root, 'pending')) as items:
+            for item in items:
+                try:
+                    if item.stat().st_mtime < cutoff:
+                        os.unlink(item.path)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,630 @@
+import os
+import time
+import zlib
+import fcntl
+import threading
+import tempfile
+import logging
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+import requests
+import upstream
+import bandwidth
+from cache import CHAPTERS, chapterKey
+
+cloud_logger = logging.getLogger("cloudLogger")
+
+# Chapter download concurrency
+GLOBAL_LIMIT = 8  # Chapters fetched at once across every download in this worker
+HOST_LIMIT = 4  # Chapters fetched at once from any single host
+REORDER_WINDOW = 6  # Chapters of one book allowed in flight or waiting to be written
+CHUNK_SIZE = 64 * 1024  # Bytes read from upstream and handed to the archive at a time
+BUFFER_DIR = None  # Where chapters waiting their turn are spooled; None uses the system temp dir
+REMOTE_POLL = 0.05  # Seconds between checks on a chapter another worker is fetching
+PARTIAL_MIN_SIZE = 1024 * 1024  # Abandoned chapters with at least this much downloaded are kept to resume
+
+# Segmented downloads of single large chapters
+SEGMENT_MIN_SIZE = 16 * 1024 * 1024  # Chapters smaller than this always come down one connection
+SEGMENTS = 4  # Connections one large chapter is split across, including the first
+HOST_SEGMENT_LIMIT = 4  # Extra range connections open at once to any single host; with
+                        # HOST_LIMIT this must stay within upstream.POOL_SIZE
+SEGMENT_WORKERS = 8  # Range requests running at once across every chapter in this worker
+
+# Resuming chapters whose connection drops part way
+RETRY_LIMIT = 5  # Tail re-requests one chapter may make, across all of its connections
+RETRY_BACKOFF = 1.0  # Seconds before the first re-request, doubling for each one after
+RETRY_BACKOFF_MAX = 30.0  # Longest wait between re-requests
+# Probing chapter sizes before downloading
+PROBE_WORKERS = 8  # HEAD requests running at once across every probe in this worker
+PROBE_TIMEOUT = (5, 5)  # Seconds to connect, seconds to answer, for one chapter
+PROBE_BUDGET = 10  # Seconds a whole book's probe may take; chapters still unanswered count as unknown
+DEAD_STATUSES = (401, 403, 404, 410)  # Upstream answers meaning the chapter will never download
+
+# Chapters are fetched as stored, so lengths and byte ranges count the bytes we read
+IDENTITY = {'Accept-Encoding': 'identity'}
+
+RESUMABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+_executors = {}
+_hostSlots = {}
+_hostSegmentSlots = {}
+_lock = threading.Lock()
+_flights = {}  # Chapter key -> ChapterBuffer being read or filled in this worker
+_flightsLock = threading.Lock()
+
+def getExecutor(name='chapter', workers=GLOBAL_LIMIT):
+    # Thread pool for one kind of download work, shared by every request in this worker
+    with _lock:
+        if name not in _executors:
+            _executors[name] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        return _executors[name]
+
+def getHostSlots(url, slots=_hostSlots, limit=HOST_LIMIT):
+    host = urlparse(url).netloc
+    with _lock:
+        if host not in slots:
+            slots[host] = threading.BoundedSemaphore(limit)
+        return slots[host]
+
+def getHostSegmentSlots(url):
+    return getHostSlots(url, _hostSegmentSlots, HOST_SEGMENT_LIMIT)
+
+class ChapterBuffer:
+    # Disk-backed buffer that a fetch thread fills while archive writers drain it, so only
+    # one chunk per reader is ever held in memory. Any number of readers can follow the
+    # same buffer, each at its own offset.
+    #
+    # With a cache, a cached chapter is read straight from disk. Otherwise the partial file
+    # for the chapter is shared by every gunicorn worker: the worker holding its lock fetches
+    # it ("leader") and commits it to the cache, while the others tail it ("remote").
+    # A leader that is abandoned or fails part way keeps what it has for the next one to resume,
+    # which is usually a remote buffer taking the chapter over.
+    def __init__(self, url, cache=None, owner=None, weight=bandwidth.INTERACTIVE_WEIGHT):
+        self.url = url
+        self.key = chapterKey(url)
+        self.cache = cache
+        self.owner = owner  # Whose share of the ingress bandwidth the fetch uses
+        self.weight = weight
+        self.pendingPath = None
+        self.leader = True
+        self.remote = False
+        self.refs = 1
+        self.size = 0
+        self.crc = 0
+        self.contentLength = None
+        self.validator = None
+        self.response = None
+        self.started = False
+        self.failed = False
+        self.done = False
+        self.closed = False
+        self.cond = threading.Condition()
+
+        self.file = cache.open(CHAPTERS, self.key) if cache else None
+        if self.file:
+            self.markCached()
+        elif cache:
+            self.claim()
+        else:
+            self.file = tempfile.TemporaryFile(dir=BUFFER_DIR)
+
+    def claim(self):
+        # Become the worker filling the chapter's shared partial file, or follow the one that is
+        self.file, self.pendingPath, self.leader = self.cache.claim(CHAPTERS, self.key)
+        self.remote = not self.leader
+        if self.leader:
+            # Another worker may have committed it between our lookup and our claim
+            cached = self.cache.open(CHAPTERS, self.key)
+            if cached:
+                self.unlock(discard=True)
+                self.file.close()
+                self.file = cached
+                self.markCached()
+        else:
+            self.pendingPath = None
+
+    def markCached(self):
+        self.size = self.contentLength = os.fstat(self.file.fileno()).st_size
+        self.started = self.done = True
+        self.leader = self.remote = False
+
+    def unlock(self, discard=False):
+        # Let other workers know the partial file is settled, one way or the other
+        if discard and self.pendingPath:
+            self.cache.discard(self.pendingPath)
+        self.pendingPath = None
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+    def attach(self, response):
+        # Upstream response being read into this buffer, so closing the buffer can cut it off
+        self.response = response
+
+    def start(self, contentLength):
+        with self.cond:
+            self.started = True
+            self.contentLength = int(contentLength) if contentLength else None
+            self.cond.notify_all()
+
+    def write(self, chunk):
+        with self.cond:
+            if self.closed:
+                raise ValueError(f"Chapter buffer for {self.url} was closed")
+            os.pwrite(self.file.fileno(), chunk, self.size)
+            self.size += len(chunk)
+            self.crc = zlib.crc32(chunk, self.crc)
+            self.cond.notify_all()
+
+    def finish(self, ok):
+        with self.cond:
+            self.done = True
+            self.failed = not ok
+            if self.pendingPath and not self.closed:
+                self.settle(ok)
+            self.cond.notify_all()
+
+    def settle(self, ok):
+        # Caller holds cond. Hand over the partial file: to the cache once complete, else
+        # kept for a later download to resume if enough of it arrived, else thrown away
+        if ok:
+            # The open file keeps reading the same data after it moves into the cache
+            self.cache.commit(CHAPTERS, self.key, self.pendingPath, self.crc)
+            self.unlock()
+        elif self.size >= PARTIAL_MIN_SIZE and self.validator:
+            self.cache.keepPartial(CHAPTERS, self.key, self.pendingPath, self.validator)
+            self.unlock()
+        else:
+            self.unlock(discard=True)
+
+    def refreshRemote(self):
+        # Catch up with the worker filling this chapter; done once it lets go of the lock
+        fd = self.file.fileno()
+        size = os.fstat(fd).st_size
+        if size > self.size:
+            self.size = size
+            self.started = True
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+        # Committed if the cached file is the very file we have been reading
+        if self.cache.isPath(fd, self.cache.path(CHAPTERS, self.key)):
+            self.size = self.contentLength = os.fstat(fd).st_size
+            self.started = self.done = True
+            self.remote = False
+        else:
+            self.takeOver()
+
+    def takeOver(self):
+        # Caller holds cond. The worker filling this chapter let go without committing it,
+        # usually because its own download was abandoned. Rather than failing everyone
+        # following it here, claim the chapter and fetch it ourselves, from whatever that
+        # worker kept, or follow whichever worker claimed it first. Readers' offsets stay
+        # valid because the new file holds the same bytes from the start.
+        cloud_logger.info(f"Taking over {self.url} from a worker that stopped fetching it")
+        self.file.close()
+        self.size = self.crc = 0
+        self.started = False
+        self.contentLength = None
+        self.file = self.cache.open(CHAPTERS, self.key)
+        if self.file:
+            self.markCached()
+            return
+        self.claim()
+        if self.leader and not self.done:
+            getExecutor().submit(fetchChapter, self)
+
+    def waitUntil(self, predicate):
+        # Caller holds cond. Remote buffers have no writer in this process to notify us,
+        # so they poll the shared file instead.
+        while not predicate():
+            if self.remote:
+                self.cond.wait(REMOTE_POLL)
+                self.refreshRemote()
+            else:
+                self.cond.wait()
+
+    def waitForStatus(self):
+        # True once upstream has answered 200, False if the fetch failed first
+        with self.cond:
+            self.waitUntil(lambda: self.started or self.done)
+            return self.started
+
+    def iterChunks(self, chunkSize=CHUNK_SIZE, start=0, stop=None):
+        # Bytes [start, stop) of the chapter as they arrive, to the end if stop is None
+        offset = start
+        while stop is None or offset < stop:
+            with self.cond:
+                self.waitUntil(lambda: self.size > offset or self.done)
+                size = self.size if stop is None else min(self.size, stop)
+                failed = self.failed
+                if offset < size:
+                    data = os.pread(self.file.fileno(), min(chunkSize, size - offset), offset)
+            if offset < size:
+                offset += len(data)
+                yield data
+            elif failed:
+                raise IOError(f"Download of {self.url} failed after {offset} bytes")
+            else:
+                return
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            if self.response:
+                # Stop a fetch blocked on upstream now rather than at its next chunk
+                try:
+                    self.response.raw.close()
+                except Exception:
+                    pass
+            if self.pendingPath:
+                self.settle(False)
+            self.file.close()
+            self.cond.notify_all()
+
+def openChapter(url, cache=None, owner=None, weight=bandwidth.INTERACTIVE_WEIGHT):
+    # Buffer for url, shared with any fetch of it already running in this worker.
+    # Returns (buffer, fetch) where fetch tells the caller it must start the fetch itself,
+    # paced as owner's. Every buffer returned must be handed back to releaseChapter.
+    key = chapterKey(url)
+    with _flightsLock:
+        buffer = _flights.get(key)
+        if buffer and not buffer.closed and not buffer.failed:
+            buffer.refs += 1
+            return buffer, False
+        buffer = ChapterBuffer(url, cache, owner, weight)
+        if not buffer.done:
+            _flights[key] = buffer
+        return buffer, buffer.leader and not buffer.done
+
+def releaseChapter(buffer):
+    # Drop one reader; the last one out closes the buffer, which stops a fetch still running
+    with _flightsLock:
+        buffer.refs -= 1
+        if buffer.refs > 0:
+            return
+        if _flights.get(buffer.key) is buffer:
+            del _flights[buffer.key]
+    buffer.close()
+
+def fetchChapter(buffer):
+    # Fill one chapter's buffer from the object store if it holds the chapter, else from upstream
+    ok = False
+    try:
+        store = buffer.cache.store if buffer.cache else None
+        if store and store.has(CHAPTERS, chapterKey(buffer.url)):
+            ok = fetchStoredChapter(buffer, store)
+        else:
+            ok = fetchUpstreamChapter(buffer)
+    except Exception as e:
+        if buffer.closed:
+            cloud_logger.info(f"Stopped downloading {buffer.url}, its download was abandoned")
+        else:
+            cloud_logger.info(f"Error downloading {buffer.url}: {e}")
+    finally:
+        buffer.finish(ok)
+
+def fetchAndRelease(buffer):
+    # Fetch a chapter for a caller that is not waiting on it, such as a background cache fill
+    try:
+        fetchChapter(buffer)
+    finally:
+        releaseChapter(buffer)
+
+class RetryBudget:
+    # Re-requests left for one chapter, shared by every connection fetching part of it
+    def __init__(self, retries=RETRY_LIMIT):
+        self.left = retries
+        self.attempt = 0
+        self.lock = threading.Lock()
+
+    def spend(self, url, position):
+        # Wait out the backoff and return True, or False once the budget is used up
+        with self.lock:
+            if self.left <= 0:
+                cloud_logger.info(f"Giving up on {url} at byte {position}, out of retries")
+                return False
+            self.left -= 1
+            delay = min(RETRY_BACKOFF * 2 ** self.attempt, RETRY_BACKOFF_MAX)
+            self.attempt += 1
+        cloud_logger.info(f"Resuming {url} from byte {position} in {delay:.1f}s")
+        time.sleep(delay)
+        return True
+
+def fetchUpstreamChapter(buffer):
+    with getHostSlots(buffer.url):
+        if buffer.closed:
+            return False  # The download was abandoned before this chapter's turn
+        partial = buffer.cache.takePartial(CHAPTERS, buffer.key) if buffer.pendingPath else None
+        if partial:
+            resumed = resumePartial(buffer, *partial)
+            if resumed is not None:
+                return resumed
+
+        cloud_logger.info(f"Attempting to download file at URL: {buffer.url}")
+        with upstream.get(buffer.url, stream=True, headers=IDENTITY) as response:
+            if response.status_code != 200:
+                cloud_logger.info(f"Failed to download {buffer.url}. Status code: {response.status_code}")
+                return False
+            buffer.attach(response)
+            buffer.start(plainLength(response))
+            chunks = readResponse(buffer, response)
+            validator = buffer.validator = rangeValidator(response)
+            budget = RetryBudget()
+
+            # The GET doubles as the probe: split the rest of a large chapter over extra connections
+            length = segmentableLength(response)
+            slots = getHostSegmentSlots(buffer.url)
+            extra = 0
+            while length and extra < SEGMENTS - 1 and slots.acquire(blocking=False):
+                extra += 1
+            if extra:
+                return fetchSegmented(buffer, response, chunks, length, extra, slots, validator, budget)
+
+            try:
+                streamInto(buffer.write, chunks, 0, buffer.contentLength)
+            except RESUMABLE_ERRORS as e:
+                cloud_logger.info(f"Connection to {buffer.url} dropped after {buffer.size} bytes: {e}")
+                if buffer.contentLength is None:
+                    return False  # Without a length there is no telling what is missing
+        # Only the bytes we are short of are fetched again
+        if buffer.contentLength is None:
+            return True
+        return resumeRange(buffer, 0, buffer.contentLength, validator, budget)
+
+def resumePartial(buffer, partial, validator):
+    # Carry on from where an abandoned download of this chapter stopped. None if upstream
+    # will not serve the rest of the same version of the file, which then starts over.
+    with partial:
+        start = os.fstat(partial.fileno()).st_size
+        response = openRange(buffer.url, start, None, validator)
+        if response is None:
+            return None
+        with response:
+            total = response.headers['Content-Range'].rpartition('/')[2]
+            if not total.isdigit():
+                return None
+            total = int(total)
+            cloud_logger.info(f"Resuming {buffer.url} from byte {start} kept by an abandoned download")
+            buffer.attach(response)
+            buffer.validator = validator
+            buffer.start(total)
+            for data in iter(lambda: partial.read(CHUNK_SIZE), b''):
+                buffer.write(data)
+            try:
+                streamInto(buffer.write, readResponse(buffer, response), start, total)
+            except RESUMABLE_ERRORS as e:
+                cloud_logger.info(f"Connection to {buffer.url} dropped after {buffer.size} bytes: {e}")
+    return resumeRange(buffer, 0, total, validator, RetryBudget())
+
+def rangeValidator(response):
+    # Value for If-Range that pins later range requests to this version of the file
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag  # Weak ETags are not allowed in If-Range
+    return response.headers.get('Last-Modified')
+
+def plainLength(response):
+    # Content-Length if it counts the bytes we will actually read, else None
+    length = response.headers.get('Content-Length', '')
+    if not length.isdigit() or response.headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    return int(length)
+
+def segmentableLength(response):
+    # Size of a chapter worth fetching in byte ranges, or None if it must come down in one stream
+    length = plainLength(response)
+    if response.headers.get('Accept-Ranges', '').lower() != 'bytes' or length is None:
+        return None
+    if length < SEGMENT_MIN_SIZE:
+        return None
+    return length
+
+def readResponse(buffer, response):
+    # Body of an upstream response, paced to the ingress share of whoever the buffer is for
+    return bandwidth.ingress.throttle(buffer.owner, response.iter_content(chunk_size=CHUNK_SIZE), buffer.weight)
+
+def streamInto(write, chunks, position, stop):
+    # Write chunks until position reaches stop, or until they run out if stop is None.
+    # Returns the new position and whatever of the last chunk lay past stop.
+    for chunk in chunks:
+        if stop is not None and position + len(chunk) >= stop:
+            write(chunk[:stop - position])
+            return stop, chunk[stop - position:]
+        write(chunk)
+        position += len(chunk)
+    return position, b''
+
+def openRange(url, start, stop, validator):
+    # Streaming response for bytes [start, stop) of url, to the end if stop is None,
+    # or None if upstream will not serve them
+    span = f"{start}-{stop - 1}" if stop is not None else f"{start}-"
+    headers = {'Range': f"bytes={span}", **IDENTITY}
+    if validator:
+        headers['If-Range'] = validator  # A changed file comes back whole and is refused
+    response = upstream.get(url, stream=True, headers=headers)
+    if response.status_code != 206 or not response.headers.get('Content-Range', '').startswith(f"bytes {start}-"):
+        cloud_logger.info(f"Range {span} of {url} refused. Status code: {response.status_code}")
+        response.close()
+        return None
+    return response
+
+def resumeRange(buffer, base, stop, validator, budget):
+    # Re-request the bytes missing from buffer, which holds the file from offset base, until
+    # all of [base, stop) has arrived, the budget runs out or the buffer is abandoned. The
+    # position is worked out from the buffer every time, since a drop can come mid-range.
+    while base + buffer.size < stop:
+        position = base + buffer.size
+        if buffer.closed or not budget.spend(buffer.url, position) or buffer.closed:
+            return False
+        try:
+            response = openRange(buffer.url, position, stop, validator)
+            if response is None:
+                return False
+            with response:
+                buffer.attach(response)
+                streamInto(buffer.write, readResponse(buffer, response), position, stop)
+        except RESUMABLE_ERRORS as e:
+            cloud_logger.info(f"Connection to {buffer.url} dropped again after {buffer.size} bytes: {e}")
+    return True
+
+def fetchSegmented(buffer, response, chunks, length, extra, slots, validator, budget):
+    # Read the first segment from the open response while range requests fetch the others
+    # into their own spool files, then copy those into the buffer in order. If upstream turns
+    # down any range request, carry on reading the original response as a single stream.
+    size = -(-length // (extra + 1))
+    ranges = [(start, min(start + size, length)) for start in range(size, length, size)]
+    for unused in range(extra - len(ranges)):
+        slots.release()
+    segments = [ChapterBuffer(buffer.url, owner=buffer.owner, weight=buffer.weight) for start, stop in ranges]
+    executor = getExecutor('segment', SEGMENT_WORKERS)
+    for segment, (start, stop) in zip(segments, ranges):
+        executor.submit(fetchSegment, segment, start, stop, validator, slots, budget)
+    try:
+        rest = None
+        try:
+            position, rest = streamInto(buffer.write, chunks, 0, size)
+        except RESUMABLE_ERRORS as e:
+            cloud_logger.info(f"Connection to {buffer.url} dropped after {buffer.size} bytes: {e}")
+        if buffer.size < size:
+            rest = None
+            if not resumeRange(buffer, 0, size, validator, budget):
+                return False
+
+        if not all(segment.waitForStatus() for segment in segments):
+            cloud_logger.info(f"Range requests refused for {buffer.url}, continuing on one connection")
+            for segment in segments:
+                segment.close()
+            if rest is not None:
+                try:
+                    buffer.write(rest)
+                    streamInto(buffer.write, chunks, buffer.size, length)
+                except RESUMABLE_ERRORS as e:
+                    cloud_logger.info(f"Connection to {buffer.url} dropped after {buffer.size} bytes: {e}")
+            return resumeRange(buffer, 0, length, validator, budget)
+
+        response.close()
+        cloud_logger.info(f"Downloading {buffer.url} in {len(segments) + 1} segments")
+        for segment in segments:
+            for data in segment.iterChunks():
+                buffer.write(data)
+        return True
+    finally:
+        for segment in segments:
+            segment.close()
+
+def fetchSegment(segment, start, stop, validator, slots, budget):
+    # Fill one segment's spool file from a byte range of its chapter, resuming it if it drops
+    ok = False
+    try:
+        if segment.closed:
+            return
+        response = openRange(segment.url, start, stop, validator)
+        if response is None:
+            return
+        segment.attach(response)
+        segment.start(stop - start)
+        try:
+            with response:
+                streamInto(segment.write, readResponse(segment, response), start, stop)
+        except RESUMABLE_ERRORS as e:
+            cloud_logger.info(f"Connection for range {start}-{stop - 1} of {segment.url} dropped: {e}")
+        ok = resumeRange(segment, start, stop, validator, budget)
+    except Exception as e:
+        cloud_logger.info(f"Error downloading range {start}-{stop - 1} of {segment.url}: {e}")
+    finally:
+        slots.release()
+        segment.finish(ok)
+
+def fetchStoredChapter(buffer, store):
+    # Refill the local cache from the object store instead of upstream
+    cloud_logger.info(f"Reading {buffer.url} from object store")
+    with store.openObject(CHAPTERS, chapterKey(buffer.url)) as reader:
+        buffer.start(None)
+        chunks = iter(lambda: reader.read(CHUNK_SIZE), b'')
+        for chunk in bandwidth.ingress.throttle(buffer.owner, chunks, buffer.weight):
+            buffer.write(chunk)
+    return True
+
+class ChapterProbe:
+    # What upstream says about a chapter before we download it. size is None when unknown,
+    # and dead is only set for answers that retrying will not change.
+    def __init__(self, url, size=None, validator=None, status=None, dead=False):
+        self.url = url
+        self.size = size
+        self.validator = validator
+        self.status = status
+        self.dead = dead
+
+def probeChapter(url, cache=None):
+    path = cache.lookup(CHAPTERS, chapterKey(url)) if cache else None
+    if path:
+        try:
+            return ChapterProbe(url, os.path.getsize(path), status=200)
+        except FileNotFoundError:
+            pass  # Evicted since the lookup
+
+    try:
+        response = upstream.head(url, headers=IDENTITY, timeout=PROBE_TIMEOUT)
+        if response.status_code == 200 and plainLength(response) is not None:
+            return ChapterProbe(url, plainLength(response), rangeValidator(response), 200)
+        if response.status_code in DEAD_STATUSES:
+            return ChapterProbe(url, status=response.status_code, dead=True)
+
+        # Some hosts refuse HEAD or leave out the length, so ask for the first byte instead
+        with upstream.get(url, stream=True, headers={'Range': 'bytes=0-0', **IDENTITY}, timeout=PROBE_TIMEOUT) as response:
+            status = response.status_code
+            size = None
+            if status == 206:
+                total = response.headers.get('Content-Range', '').rpartition('/')[2]
+                size = int(total) if total.isdigit() else None
+            elif status == 200:
+                size = plainLength(response)
+            return ChapterProbe(url, size, rangeValidator(response), status, status in DEAD_STATUSES)
+    except Exception as e:
+        cloud_logger.info(f"Error probing {url}: {e}")
+        return ChapterProbe(url)
+
+def probeChapters(audioFiles, cache=None, budget=PROBE_BUDGET):
+    # Probe every chapter at once, returning {index: ChapterProbe} within budget seconds
+    executor = getExecutor('probe', PROBE_WORKERS)
+    futures = {executor.submit(probeChapter, url, cache): index for index, url in audioFiles.items()}
+    probes = {index: ChapterProbe(url) for index, url in audioFiles.items()}
+    try:
+        for future in as_completed(futures, timeout=budget):
+            probes[futures[future]] = future.result()
+    except FuturesTimeoutError:
+        cloud_logger.info(f"Probe of {len(audioFiles)} chapters ran out of time, sizes left unknown")
+        for future in futures:
+            future.cancel()
+    return probes
+
+def iterChapters(audioFiles, window=REORDER_WINDOW, cache=None, owner=None, weight=bandwidth.INTERACTIVE_WEIGHT):
+    # Fetch chapters in parallel, yielding (index, url, buffer) in chapter order.
+    # Only `window` chapters are ever started ahead of the one being yielded, and each
+    # buffer is released once the caller moves on to the next chapter. A chapter that
+    # another download is already fetching is followed rather than fetched again.
+    items = list(audioFiles.items())
+    executor = getExecutor()
+    buffers = {}
+    nextSubmit = 0
+    try:
+        for position, (index, url) in enumerate(items):
+            while nextSubmit < len(items) and nextSubmit < position + window:
+                buffers[nextSubmit], fetch = openChapter(items[nextSubmit][1], cache, owner, weight)
+                if fetch:
+                    executor.submit(fetchChapter, buffers[nextSubmit])
+                nextSubmit += 1
+            buffer = buffers.pop(position)
+            try:
+                yield index, url, buffer
+            finally:
+                releaseChapter(buffer)
+    finally:
+        for buffer in buffers.values():
+            releaseChapter(buffer)
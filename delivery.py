@@ -0,0 +1,108 @@
+import os
+import unicodedata
+from datetime import datetime, timezone
+from urllib.parse import quote
+from flask import Response, request
+from werkzeug.http import is_resource_modified
+
+BLOCK_SIZE = 64 * 1024  # Read size when the server cannot sendfile
+
+def attachmentFilename(download_name):
+    # Content-Disposition filename options, built the way send_file does
+    try:
+        download_name.encode('ascii')
+        return {'filename': download_name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        return {'filename': simple, 'filename*': f"UTF-8''{quote(download_name, safe='!#$&+^`|~')}"}
+
+def fileValidators(file):
+    # Strong ETag and Last-Modified from the file itself, stable for as long as its bytes are
+    stat = os.fstat(file.fileno())
+    lastModified = datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+    return f"{stat.st_ino:x}-{int(stat.st_mtime):x}-{stat.st_size:x}", lastModified, stat.st_size
+
+def requestedRange(size, etag, lastModified):
+    # (start, stop) to send for this request, None for the whole file, or False if unsatisfiable
+    byteRange = request.range
+    if byteRange is None:
+        return None
+
+    # If-Range: only honour the range if the client's copy is still the one we have
+    ifRange = request.if_range
+    if ifRange.etag is not None and ifRange.etag != etag:
+        return None
+    if ifRange.date is not None and ifRange.date < lastModified:
+        return None
+
+    span = byteRange.range_for_length(size)
+    if span is None and len(byteRange.ranges) == 1:
+        return False
+    return span  # Multiple ranges are answered with the whole file
+
+def iterFile(file, start, length):
+    try:
+        file.seek(start)
+        while length > 0:
+            data = file.read(min(BLOCK_SIZE, length))
+            if not data:
+                return
+            length -= len(data)
+            yield data
+    finally:
+        file.close()
+
+def fileBody(file, start, length):
+    # Hand the open file to the server's wsgi.file_wrapper so gunicorn can sendfile() it.
+    # Servers must not send past Content-Length, so positioning the file is enough for a range.
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper:
+        file.seek(start)
+        return file_wrapper(file, BLOCK_SIZE)
+    return iterFile(file, start, length)
+
+def sendFile(file, download_name, mimetype, pace=None, disposition='attachment'):
+    # Serve an open file without reading it into Python, honouring conditional GETs,
+    # Range and If-Range so an interrupted download can resume where it stopped.
+    # pace(chunks) paces the body, at the cost of reading it through Python instead of sendfile.
+    etag, lastModified, size = fileValidators(file)
+    if pace:
+        body = lambda start, length: pace(iterFile(file, start, length))
+    else:
+        body = lambda start, length: fileBody(file, start, length)
+    return sendRanges(size, etag, lastModified, body, file.close, download_name, mimetype, disposition)
+
+def sendVirtual(virtual, download_name, mimetype, pace=None):
+    # Serve an archive that only exists as a layout over other files (archive.VirtualZip)
+    lastModified = datetime.fromtimestamp(int(virtual.lastModified), timezone.utc)
+    body = virtual.iterRange
+    if pace:
+        body = lambda start, length: pace(virtual.iterRange(start, length))
+    return sendRanges(virtual.size, virtual.etag, lastModified, body, virtual.close, download_name, mimetype)
+
+def sendRanges(size, etag, lastModified, body, close, download_name, mimetype, disposition='attachment'):
+    # body(start, length) gives the bytes to send; close() releases them once the response is
+    # closed, which also covers bodies that are never read, such as HEAD or an early disconnect
+    if not is_resource_modified(request.environ, etag=etag, last_modified=lastModified):
+        response = Response(status=304)
+    else:
+        span = requestedRange(size, etag, lastModified)
+        if span is False:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f"bytes */{size}"
+        elif span is None:
+            response = Response(body(0, size), mimetype=mimetype, direct_passthrough=True)
+            response.content_length = size
+        else:
+            start, stop = span
+            response = Response(body(start, stop - start), 206, mimetype=mimetype, direct_passthrough=True)
+            response.content_length = stop - start
+            response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+
+    response.call_on_close(close)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers.set('Content-Disposition', disposition, **attachmentFilename(download_name))
+    response.set_etag(etag)
+    response.last_modified = lastModified
+    return response
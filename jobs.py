@@ -0,0 +1,166 @@
+import os
+import re
+import json
+import time
+import uuid
+import tempfile
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+cloud_logger = logging.getLogger("cloudLogger")
+
+JOB_WORKERS = 2  # Downloads assembled at once in this worker
+PROGRESS_INTERVAL = 1.0  # Seconds between progress writes for one job
+JOB_TTL = 24 * 3600  # Job records older than this are removed
+HEARTBEAT_INTERVAL = 5  # Seconds between heartbeats for the jobs a worker holds
+STALE_SECONDS = 30  # A queued or running job with no heartbeat for this long lost its worker
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+class JobStore:
+    # Download jobs run on a thread pool in the worker that accepted them. Their state is
+    # written to a shared directory so a progress request can land on any gunicorn worker.
+    # The worker refreshes 'updated' on its jobs as a heartbeat; a job whose worker was
+    # restarted stops beating and is reported as failed instead of running forever.
+    def __init__(self, root, workers=JOB_WORKERS):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.active = {}  # Job id -> job held by this worker
+        self.lock = threading.Lock()
+        self.heartbeatPid = None
+
+    def path(self, jobId):
+        return os.path.join(self.root, f"{jobId}.json")
+
+    def create(self, **fields):
+        self.clearExpired()
+        now = time.time()
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': QUEUED,
+            'created': now,
+            'updated': now,
+            'chapter': None,
+            'chapters': 0,
+            'bytesDone': 0,
+            'bytesTotal': None,
+            'error': None,
+        }
+        job.update(fields)
+        self.save(job)
+        return job
+
+    def save(self, job):
+        with self.lock:
+            job['updated'] = time.time()
+            fd, pendingPath = tempfile.mkstemp(dir=self.root, suffix='.part')
+            with os.fdopen(fd, 'w') as file:
+                json.dump(job, file)
+            os.replace(pendingPath, self.path(job['id']))
+
+    def load(self, jobId):
+        if not re.fullmatch(r'[0-9a-f]{32}', jobId or ''):
+            return None
+        try:
+            with open(self.path(jobId)) as file:
+                job = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+        if job['status'] in (QUEUED, RUNNING) and time.time() - job['updated'] > STALE_SECONDS:
+            cloud_logger.info(f"Download job {jobId} lost worker {job.get('pid')}")
+            job['status'] = FAILED
+            job['error'] = 'The server restarted while preparing this download'
+            self.save(job)
+        return job
+
+    def submit(self, job, work):
+        # work(progress) does the download, reporting through the JobProgress it is given
+        job['pid'] = os.getpid()
+        with self.lock:
+            self.active[job['id']] = job
+            if self.heartbeatPid != os.getpid():
+                # Threads do not survive a fork, so each worker starts its own
+                self.heartbeatPid = os.getpid()
+                threading.Thread(target=self.heartbeat, name='job-heartbeat', daemon=True).start()
+        self.save(job)
+        self.executor.submit(self.run, job, work)
+
+    def run(self, job, work):
+        job['status'] = RUNNING
+        self.save(job)
+        try:
+            work(JobProgress(self, job))
+            job['status'] = DONE
+        except Exception as e:
+            cloud_logger.info(f"Download job {job['id']} failed: {e}")
+            job['status'] = FAILED
+            job['error'] = str(e)
+        finally:
+            with self.lock:
+                self.active.pop(job['id'], None)
+        self.save(job)
+
+    def heartbeat(self):
+        # Keep this worker's jobs fresh while they wait for a slot or for a slow chapter
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            with self.lock:
+                held = list(self.active.values())
+            for job in held:
+                self.save(job)
+
+    def clearExpired(self):
+        cutoff = time.time() - JOB_TTL
+        with os.scandir(self.root) as items:
+            for item in items:
+                try:
+                    if item.stat().st_mtime < cutoff:
+                        os.unlink(item.path)
+                except FileNotFoundError:
+                    pass
+
+class JobProgress:
+    # Progress callbacks for one job, saved at most every PROGRESS_INTERVAL seconds
+    def __init__(self, store, job):
+        self.store = store
+        self.job = job
+        self.lengths = {}
+        self.lastSave = 0
+
+    def setLengths(self, lengths):
+        # Chapter sizes known before the download starts, e.g. from a probe
+        self.lengths.update(lengths)
+        self.save(force=True)
+
+    def startChapter(self, index, contentLength):
+        self.job['chapter'] = index
+        self.lengths[index] = contentLength or self.lengths.get(index)
+        self.save(force=True)
+
+    def advance(self, nbytes):
+        self.job['bytesDone'] += nbytes
+        self.save()
+
+    def track(self, chunks):
+        for chunk in chunks:
+            self.advance(len(chunk))
+            yield chunk
+
+    def estimateTotal(self):
+        # Exact once every chapter's length is known, otherwise scaled up from the known ones
+        known = [length for length in self.lengths.values() if length]
+        if not known or not self.job['chapters']:
+            return None
+        return int(sum(known) / len(known) * self.job['chapters'])
+
+    def save(self, force=False):
+        now = time.monotonic()
+        if force or now - self.lastSave >= PROGRESS_INTERVAL:
+            self.job['bytesTotal'] = self.estimateTotal()
+            self.lastSave = now
+            self.store.save(self.job)
@@ -1,5 +1,6 @@
 from bs4 import BeautifulSoup
-import requests
+import upstream
+import chapters
 import json
 import os
 import logging
@@ -19,7 +20,7 @@ def cookSoup(url):
     cloud_logger.info(f"Cooking soup with url: {url}")
     try:
         cloud_logger.info("trying")
-        response = requests.get(url, timeout=10)
+        response = upstream.get(url, timeout=10)
         cloud_logger.info(f"Redirect history: {response.history}")
         cloud_logger.info(f"Response status code: {response.status_code}")
         cloud_logger.info(f"Response content (first 100 chars): {response.text[:100]}")
@@ -97,18 +98,21 @@ def audioRequest(audioFiles,bookDict,folder):
             file_name = f"{title}_{index:02}.mp3"
             file_path = os.path.join(folder,file_name)
 
-            # Send GET request
-            response = requests.get(url, stream=True)
-            # Ensure response was recieved
-            if response.status_code == 200:
-                # Save audio file
-                with open(file_path, 'wb') as file:
-                    for chunk in response.iter_content(chunk_size=1024):
-                        if chunk:
+            # Fetch through the chapter downloader, which splits large files over several connections
+            buffer = chapters.ChapterBuffer(url)
+            try:
+                chapters.fetchChapter(buffer)
+                # Ensure the download completed
+                if not buffer.failed:
+                    # Save audio file
+                    with open(file_path, 'wb') as file:
+                        for chunk in buffer.iterChunks():
                             file.write(chunk)
-                print(f"Downloaded {file_name}")
-            else:
-                print(f"Failed to download {url}. Status code: {response.status_code}")
+                    print(f"Downloaded {file_name}")
+                else:
+                    print(f"Failed to download {url}")
+            finally:
+                buffer.close()
     except Exception as e:
         print(f"Error in main function audioRequest: {e}")
 
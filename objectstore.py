@@ -0,0 +1,163 @@
+import os
+import time
+import shutil
+import threading
+import logging
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from itsdangerous import URLSafeSerializer, BadSignature
+from werkzeug.http import dump_options_header
+import google.auth.credentials
+import google.auth.transport.requests
+import delivery
+
+cloud_logger = logging.getLogger("cloudLogger")
+
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Resumable upload chunk; must be a multiple of 256 KiB
+UPLOAD_WORKERS = 2  # Background uploads running at once in this worker
+KNOWN_SECONDS = 3600  # How long we trust that an object exists before asking the store again
+MISSING_SECONDS = 60  # How long we trust that it does not; short, since other workers upload
+KNOWN_PRUNE_AT = 10000  # Answers remembered before expired ones are cleared out
+SIGNED_URL_SECONDS = 300  # Lifetime of the redirect handed to the client
+
+class ObjectStore:
+    # Second cache tier behind the local DiskCache. Subclasses provide the backend calls;
+    # this class remembers what is and is not stored and runs uploads off the request thread.
+    def __init__(self):
+        self.known = {}  # Object name -> (found, monotonic expiry)
+        self.knownLock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='upload')
+
+    def name(self, kind, key):
+        return f"{kind}/{key}"
+
+    def has(self, kind, key):
+        return self.hasName(self.name(kind, key))
+
+    def hasName(self, name):
+        with self.knownLock:
+            found, expiry = self.known.get(name, (False, 0))
+            if expiry > time.monotonic():
+                return found
+        try:
+            found = self.exists(name)
+        except Exception as e:
+            cloud_logger.info(f"Error checking object store for {name}: {e}")
+            return False
+        self.remember(name, found, KNOWN_SECONDS if found else MISSING_SECONDS)
+        return found
+
+    def markStored(self, name):
+        self.remember(name, True, KNOWN_SECONDS)
+
+    def remember(self, name, found, seconds):
+        now = time.monotonic()
+        with self.knownLock:
+            if len(self.known) >= KNOWN_PRUNE_AT:
+                self.known = {known: answer for known, answer in self.known.items() if answer[1] > now}
+            self.known[name] = (found, now + seconds)
+
+    def uploadLater(self, kind, key, path, contentType):
+        # Open now so the upload survives the local copy being evicted before it runs
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            return
+        self.executor.submit(self.uploadFile, self.name(kind, key), file, contentType)
+
+    def uploadFile(self, name, file, contentType):
+        try:
+            with file:
+                if self.hasName(name):
+                    return
+                self.upload(name, file, contentType)
+            self.markStored(name)
+            cloud_logger.info(f"Uploaded {name} to object store")
+        except Exception as e:
+            cloud_logger.info(f"Error uploading {name} to object store: {e}")
+
+    def openObject(self, kind, key):
+        return self.openReader(self.name(kind, key))
+
+    def signedUrl(self, kind, key, download_name, contentType, seconds=SIGNED_URL_SECONDS):
+        return self.sign(self.name(kind, key), download_name, contentType, seconds)
+
+class GcsStore(ObjectStore):
+    # Google Cloud Storage bucket, and the credentials its client was built with for signing URLs
+    def __init__(self, bucket, credentials):
+        super().__init__()
+        self.bucket = bucket
+        self.credentials = credentials
+
+    def exists(self, name):
+        return self.bucket.blob(name).exists()
+
+    def upload(self, name, file, contentType):
+        # Setting a chunk size makes the client use a resumable upload session
+        blob = self.bucket.blob(name, chunk_size=UPLOAD_CHUNK_SIZE)
+        blob.upload_from_file(file, content_type=contentType, size=os.fstat(file.fileno()).st_size)
+
+    def openReader(self, name):
+        return self.bucket.blob(name).open('rb', chunk_size=UPLOAD_CHUNK_SIZE)
+
+    def sign(self, name, download_name, contentType, seconds):
+        options = {
+            'version': 'v4',
+            'method': 'GET',
+            'expiration': timedelta(seconds=seconds),
+            'response_disposition': dump_options_header('attachment', delivery.attachmentFilename(download_name)),
+            'response_type': contentType,
+        }
+        credentials = self.credentials
+        if not isinstance(credentials, google.auth.credentials.Signing):
+            # VM credentials carry no private key, so sign through IAM as the VM's service account.
+            # The access token is reused until it expires rather than fetched for every URL.
+            if not credentials.valid:
+                credentials.refresh(google.auth.transport.requests.Request())
+            options['service_account_email'] = credentials.service_account_email
+            options['access_token'] = credentials.token
+        return self.bucket.blob(name).generate_signed_url(**options)
+
+class LocalStore(ObjectStore):
+    # Directory standing in for a bucket, for development and offline testing.
+    # Signed URLs point at a route that calls resolve() to check the token.
+    def __init__(self, root, secretKey, baseUrl='/objects'):
+        super().__init__()
+        self.root = root
+        self.baseUrl = baseUrl
+        self.serializer = URLSafeSerializer(secretKey, salt='objectstore')
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def upload(self, name, file, contentType):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.part', 'wb') as target:
+            shutil.copyfileobj(file, target, UPLOAD_CHUNK_SIZE)
+        os.replace(path + '.part', path)
+
+    def openReader(self, name):
+        return open(self.path(name), 'rb')
+
+    def sign(self, name, download_name, contentType, seconds):
+        token = self.serializer.dumps({
+            'name': name,
+            'download_name': download_name,
+            'content_type': contentType,
+            'expires': time.time() + seconds,
+        })
+        return f"{self.baseUrl}/{token}"
+
+    def resolve(self, token):
+        # (path, download_name, content type) for a token that is genuine and unexpired, else None
+        try:
+            data = self.serializer.loads(token)
+        except BadSignature:
+            return None
+        if data['expires'] < time.time():
+            return None
+        return self.path(data['name']), data['download_name'], data['content_type']
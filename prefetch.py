@@ -0,0 +1,76 @@
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import chapters
+import bandwidth
+from cache import CHAPTERS, chapterKey
+
+cloud_logger = logging.getLogger("cloudLogger")
+
+PREFETCH_WORKERS = 2  # Users being prefetched for at once in this worker
+PREFETCH_CHAPTERS = 10  # Chapters warmed for one user's selection
+
+class PrefetchState:
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.buffer = None
+
+class Prefetcher:
+    # Warms the chapter cache for a selected book before the user clicks Download.
+    # Each user has at most one prefetch; a new selection or cancel() stops the old one.
+    def __init__(self, cache, workers=PREFETCH_WORKERS, maxChapters=PREFETCH_CHAPTERS):
+        self.cache = cache
+        self.maxChapters = maxChapters
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self.active = {}
+        self.lock = threading.Lock()
+
+    def start(self, owner, audioFiles, isAlive):
+        # isAlive() is checked between chapters so work stops once the owner's session is gone
+        self.cancel(owner)
+        state = PrefetchState()
+        with self.lock:
+            self.active[owner] = state
+        urls = list(audioFiles.values())[:self.maxChapters]
+        self.executor.submit(self.run, owner, urls, isAlive, state)
+
+    def cancel(self, owner):
+        with self.lock:
+            state = self.active.pop(owner, None)
+            if state:
+                state.cancelled.set()
+                if state.buffer:
+                    # Stops the in-flight fetch at its next chunk, unless a download is reading it too
+                    chapters.releaseChapter(state.buffer)
+                    state.buffer = None
+
+    def run(self, owner, urls, isAlive, state):
+        try:
+            for url in urls:
+                if state.cancelled.is_set():
+                    return
+                if not isAlive():
+                    cloud_logger.info("Session expired, stopping prefetch")
+                    return
+                if self.cache.lookup(CHAPTERS, chapterKey(url)):
+                    continue
+
+                with self.lock:
+                    if state.cancelled.is_set():
+                        return
+                    buffer, fetch = chapters.openChapter(url, self.cache, owner, bandwidth.PREFETCH_WEIGHT)
+                    state.buffer = buffer
+
+                # A chapter someone else is already fetching needs nothing from us
+                if fetch:
+                    chapters.fetchChapter(buffer)
+                with self.lock:
+                    if state.buffer is buffer:
+                        chapters.releaseChapter(buffer)
+                        state.buffer = None
+        except Exception as e:
+            cloud_logger.info(f"Error prefetching chapters: {e}")
+        finally:
+            with self.lock:
+                if self.active.get(owner) is state:
+                    del self.active[owner]
@@ -0,0 +1,198 @@
+import time
+import json
+import uuid
+import hashlib
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import cachetools
+import msgspec
+import redis
+from sites import normalize
+
+cloud_logger = logging.getLogger("cloudLogger")
+
+FRESH_SECONDS = 600  # Results younger than this are served without asking the site again
+STALE_SECONDS = 3600  # Past fresh, results are still served this long while a refresh runs
+MISS_SECONDS = 300  # A site that had no match for a search is not asked again for this long
+MAX_ENTRIES = 1024  # Searches kept in each worker's memory
+REFRESH_WORKERS = 2  # Background refreshes running at once in this worker
+REDIS_TIMEOUT = 0.25  # Seconds to wait on Redis before treating it as down
+REDIS_RETRY_SECONDS = 30  # How long to leave Redis alone after it failed
+FLIGHT_SECONDS = 15  # Longest one worker holds the lock on a search page it is fetching for the others
+FLIGHT_POLL = 0.05  # Seconds between checks on a search page another worker is fetching
+KEY_PREFIX = 'search:v2:'
+FLIGHT_PREFIX = 'search-flight:v1:'
+
+class SearchFlight:
+    # One search page being fetched and parsed in this worker, for every thread waiting on it
+    def __init__(self):
+        self.done = threading.Event()
+        self.options = None
+        self.error = None
+
+class SearchCache:
+    # Search results per (site, title, author), in an in-process TTL/LRU tier in front of a
+    # Redis tier shared by every gunicorn worker. Stale results are returned straight away
+    # while one background search replaces them. Misses are remembered too, for a shorter
+    # time. Works without Redis, one worker at a time.
+    def __init__(self, redisUrl=None, fresh=FRESH_SECONDS, stale=STALE_SECONDS, miss=MISS_SECONDS, maxEntries=MAX_ENTRIES):
+        self.fresh = fresh
+        self.stale = stale
+        self.miss = miss
+        self.local = cachetools.TTLCache(maxsize=maxEntries, ttl=fresh + stale)
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        self.flights = {}
+        self.executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS, thread_name_prefix='search-refresh')
+        self.redis = None
+        if redisUrl:
+            self.redis = redis.Redis.from_url(redisUrl, socket_connect_timeout=REDIS_TIMEOUT, socket_timeout=REDIS_TIMEOUT)
+        self.redisDownUntil = 0
+
+    def key(self, site, bookDict):
+        identity = [site, normalize(bookDict.get('title')), normalize(bookDict.get('author'))]
+        return KEY_PREFIX + hashlib.sha256(json.dumps(identity).encode('utf-8')).hexdigest()
+
+    def get(self, site, bookDict, search):
+        # bookOptions for the search, from cache when possible. search() runs the real search.
+        key = self.key(site, bookDict)
+        entry = self.lookup(key)
+        if entry and entry.get('miss'):
+            if time.time() - entry['stored'] < self.miss:
+                return {}
+        elif entry:
+            age = time.time() - entry['stored']
+            if age < self.fresh:
+                return entry['options']
+            if age < self.fresh + self.stale:
+                self.refreshLater(key, site, search)
+                return entry['options']
+        return self.refresh(key, site, search)
+
+    def isMiss(self, site, bookDict):
+        # True if site recently searched for this and found nothing
+        entry = self.lookup(self.key(site, bookDict))
+        return bool(entry and entry.get('miss') and time.time() - entry['stored'] < self.miss)
+
+    def refresh(self, key, site, search):
+        # search() returns None when the site could not be searched, which is not a miss
+        options = search()
+        if options:
+            self.store(key, {'options': options, 'stored': time.time()}, self.fresh + self.stale)
+        elif options is not None:
+            self.store(key, {'options': {}, 'stored': time.time(), 'miss': True}, self.miss)
+        return options or {}
+
+    def refreshLater(self, key, site, search):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        cloud_logger.info(f"Serving stale {site} results while refreshing them")
+        self.executor.submit(self.runRefresh, key, site, search)
+
+    def runRefresh(self, key, site, search):
+        try:
+            self.refresh(key, site, search)
+        except Exception as e:
+            cloud_logger.info(f"Error refreshing {site} results: {e}")
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def coalesce(self, site, queryUrl, search, timeout):
+        # search() for queryUrl, run once however many threads and workers want it at the same
+        # time. Everyone else waits up to timeout for the leader's options, or None on timeout.
+        key = FLIGHT_PREFIX + hashlib.sha256(json.dumps([site, queryUrl]).encode('utf-8')).hexdigest()
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = SearchFlight()
+
+        if not leader:
+            cloud_logger.info(f"Waiting on a {site} search already running in this worker")
+            if not flight.done.wait(timeout):
+                return None
+            if flight.error:
+                raise flight.error
+            return flight.options
+
+        try:
+            flight.options = self.searchShared(key, site, search, timeout)
+            return flight.options
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+    def searchShared(self, key, site, search, timeout):
+        # Take the Redis lock on key and search, or wait for the worker holding it to publish
+        # its options. Searches alone when Redis is down or the other worker gives up.
+        if not self.redisUp():
+            return search()
+        token = uuid.uuid4().hex
+        if self.redisCall(lambda client: client.set(key + ':lock', token, nx=True, ex=FLIGHT_SECONDS)):
+            try:
+                options = search()
+                if options is not None:
+                    data = msgspec.msgpack.encode(options)
+                    self.redisCall(lambda client: client.set(key + ':result', data, ex=FLIGHT_SECONDS))
+                return options
+            finally:
+                if self.redisCall(lambda client: client.get(key + ':lock')) == token.encode('utf-8'):
+                    self.redisCall(lambda client: client.delete(key + ':lock'))
+
+        cloud_logger.info(f"Waiting on a {site} search running in another worker")
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            data = self.redisCall(lambda client: client.get(key + ':result'))
+            if data:
+                return msgspec.msgpack.decode(data)
+            if not self.redisCall(lambda client: client.exists(key + ':lock')):
+                break
+            time.sleep(FLIGHT_POLL)
+        data = self.redisCall(lambda client: client.get(key + ':result'))
+        if data:
+            return msgspec.msgpack.decode(data)
+        if time.monotonic() >= deadline:
+            return None
+        return search()
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.local.get(key)
+        if entry:
+            return entry
+        data = self.redisCall(lambda client: client.get(key))
+        if not data:
+            return None
+        entry = msgspec.msgpack.decode(data)
+        with self.lock:
+            self.local[key] = entry
+        return entry
+
+    def store(self, key, entry, ttl):
+        with self.lock:
+            self.local[key] = entry
+        data = msgspec.msgpack.encode(entry)
+        self.redisCall(lambda client: client.set(key, data, ex=max(1, int(ttl))))
+
+    def redisUp(self):
+        return bool(self.redis) and time.monotonic() >= self.redisDownUntil
+
+    def redisCall(self, call):
+        # Run call(client) against Redis, or return None if there is none or it is down.
+        # After a failure Redis is skipped for a while so searches do not each wait it out.
+        if not self.redisUp():
+            return None
+        try:
+            return call(self.redis)
+        except redis.RedisError as e:
+            cloud_logger.info(f"Search cache Redis unavailable: {e}")
+            self.redisDownUntil = time.monotonic() + REDIS_RETRY_SECONDS
+            return None
@@ -0,0 +1,89 @@
+import logging
+import unicodedata
+from typing import Optional
+import msgspec
+import soupsieve
+from bs4 import SoupStrainer
+
+cloud_logger = logging.getLogger("cloudLogger")
+
+def normalize(text):
+    # The one form of a title that searches are sent, matched and cached under. Case, full
+    # width or composed characters and spacing do not change a search.
+    return ' '.join(unicodedata.normalize('NFKC', text or '').casefold().split())
+
+# Field names follow knownSites.json
+class Navigation(msgspec.Struct, frozen=True):
+    query_results_section: str  # Tag holding the search results
+    query_results_id: str  # id of that tag
+    entry: str  # Tag of one result inside it
+    entry_title: str  # Tag holding the result's title
+    audio_tag: str  # Tag of each chapter's audio player
+    file_tag: str = 'a'
+
+class SiteSpec(msgspec.Struct, frozen=True):
+    base_url: str
+    search_url: str
+    html_navigation: Navigation
+    audio_selector: str = ''
+    file_link_attr: str = ''
+    search_timeout: Optional[float] = None  # Overrides SEARCH_SITE_TIMEOUT for this site
+
+class SitePlan:
+    # A site's html_navigation compiled once into soupsieve selectors, run on every search page
+    def __init__(self, name, spec):
+        navigation = spec.html_navigation
+        self.name = name
+        self.spec = spec
+        # Search pages are parsed only inside the results section; the rest is never built
+        self.strainer = SoupStrainer(navigation.query_results_section, id=navigation.query_results_id)
+        self.results = soupsieve.compile(f"{navigation.query_results_section}#{soupsieve.escape(navigation.query_results_id)}")
+        self.entries = soupsieve.compile(navigation.entry)
+        self.entryTitle = soupsieve.compile(navigation.entry_title)
+        self.audio = soupsieve.compile(navigation.audio_tag)
+        self.source = soupsieve.compile('source[src]')
+
+    def queryUrl(self, title):
+        # Search page for title. Only the title is sent; results are matched on it alone.
+        return self.spec.search_url + normalize(title).replace(' ', '+')
+
+    def bookOptions(self, soup, userTitle):
+        # {title: {chapter: url}} for results whose title contains userTitle, compared in
+        # normalized form, or None if the page has no results section
+        userTitle = normalize(userTitle)
+        section = self.results.select_one(soup)
+        if section is None:
+            return None
+        bookOptions = {}
+        for entry in self.entries.select(section):
+            titleTag = self.entryTitle.select_one(entry)
+            if titleTag is None:
+                continue
+            title = titleTag.text
+            if userTitle in normalize(title):
+                bookOptions[title] = self.audioUrls(entry)
+        return bookOptions
+
+    def audioUrls(self, entry):
+        audioUrls = {}
+        for count, audio in enumerate(self.audio.select(entry), start=1):
+            url = audio.get('src')
+            if not url:
+                source = self.source.select_one(audio)
+                url = source['src'] if source else None
+            audioUrls[count] = url
+        return audioUrls
+
+def loadSites(path):
+    # {name: SitePlan} for every valid site in path. Sites whose config does not validate or
+    # whose selectors do not compile are left out, with the reason logged once here.
+    with open(path, 'rb') as file:
+        raw = msgspec.json.decode(file.read(), type=dict[str, msgspec.Raw])
+
+    plans = {}
+    for name, config in raw.items():
+        try:
+            plans[name] = SitePlan(name, msgspec.json.decode(config, type=SiteSpec))
+        except (msgspec.ValidationError, soupsieve.SelectorSyntaxError) as e:
+            cloud_logger.error(f"Rejecting site {name} from {path}: {e}")
+    return plans
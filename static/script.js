@@ -17,8 +17,50 @@ function searchBooks(event)
     document.getElementById('optionsHeader').style.display = 'block';
     document.getElementById('optionsList').innerHTML = '<li>Loading book options...</li>';
 
-    // Send book title and author to the flask app
-    fetch('https://ezaudiobooks.ddns.net/scrape', 
+    const optionsList = document.getElementById('optionsList');
+    const loadingItem = optionsList.firstElementChild;
+    const bookOptions = {};
+
+    // Add one site's options to the list as soon as they arrive
+    function renderOptions(siteOptions)
+    {
+        Object.keys(siteOptions).forEach(option => {
+            bookOptions[option] = siteOptions[option];
+            const index = Object.keys(bookOptions).length; // Server selections are 1-based
+            const listItem = document.createElement('li');
+            listItem.innerHTML = `<button onclick="selectBook(${index})">${option}</button>`;
+            optionsList.insertBefore(listItem, loadingItem);
+        });
+
+        // Store info locally as a fallback
+        localStorage.setItem('bookOptions', JSON.stringify(bookOptions));
+        localStorage.setItem('bookDict', JSON.stringify({title: title, author: author}));
+    }
+
+    // Handle one NDJSON event from the stream
+    function handleEvent(line)
+    {
+        if (!line.trim())
+        {
+            return;
+        }
+        const event = JSON.parse(line);
+        if (event.bookOptions)
+        {
+            renderOptions(event.bookOptions);
+        }
+        else if (event.done)
+        {
+            optionsList.removeChild(loadingItem);
+            if (!event.count)
+            {
+                alert(`No books found for ${title}`);
+            }
+        }
+    }
+
+    // Send book title and author to the flask app and read per-site results as they stream in
+    fetch('https://ezaudiobooks.ddns.net/scrape/stream', 
     {
         method: 'POST',
         credentials: 'include',
@@ -28,31 +70,29 @@ function searchBooks(event)
         },
         body: JSON.stringify({title: title, author: author})
     })
-    
-    // Handling response from the flask app
-    .then(response => response.json())
-    .then(data => {
-        console.log("data")
-        if (data.bookOptions) 
-        {
-            const bookOptions = data.bookOptions;
-            const optionsList = document.getElementById('optionsList')
-            optionsList.innerHTML = ''; // Clears any options from previous searches
-
-            Object.keys(bookOptions).forEach((option, index) => {
-                const listItem = document.createElement('li');
-                listItem.innerHTML = `<button onclick="selectBook(${index})">${option}</button>`;
-                optionsList.appendChild(listItem);
-            });
+    .then(response => {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffered = '';
 
-            // Store info locally as a fallback
-            localStorage.setItem('bookOptions', JSON.stringify(bookOptions));
-            localStorage.setItem('bookDict', JSON.stringify({title: title, author: author}));
-        } 
-        else
+        function read()
         {
-            alert(`No books found for ${title}`);
+            return reader.read().then(({done, value}) => {
+                if (done)
+                {
+                    handleEvent(buffered);
+                    return;
+                }
+                buffered += decoder.decode(value, {stream: true});
+                const lines = buffered.split('\n');
+                buffered = lines.pop(); // Keep any partial line for the next chunk
+                lines.forEach(handleEvent);
+                return read();
+            });
         }
+        return read();
+    })
+    .then(() => {
         searchButton.disabled = false; // Re-enable the button after processing
     })
     .catch(error => 
@@ -166,11 +206,92 @@ function selectBook(selection)
 
 function downloadAudioFiles()
 {
-    // Trigger single request to download the ZIP
-    const link = document.createElement('a');
-    link.href = 'https://ezaudiobooks.ddns.net/download_all';
-    link.download = `${bookTitle}_audiobook.zip`;
-    document.body.appendChild(link);
-    link.click();
-    document.body.removeChild(link);
-}
\ No newline at end of file
+    const downloadButton = document.getElementById('downloadButton');
+    downloadButton.disabled = true;
+    downloadButton.textContent = `Preparing ${bookTitle}...`;
+
+    // Start a background download job, then poll it until the archive is ready
+    fetch('https://ezaudiobooks.ddns.net/download_jobs', 
+    {
+        method: 'POST',
+        credentials: 'include'
+    })
+    .then(response => response.json())
+    .then(job => 
+    {
+        if (job.error)
+        {
+            throw new Error(job.error);
+        }
+        return pollDownloadJob(job);
+    })
+    .catch(error => 
+    {
+        console.error('Error: ', error);
+        alert('An error ocurred while preparing the download.');
+        downloadButton.disabled = false;
+        downloadButton.textContent = `Download ${bookTitle}`;
+    });
+}
+
+// Polls allowed to fail in a row, and polls allowed without any progress, before giving up
+const MAX_POLL_ERRORS = 5;
+const MAX_STALLED_POLLS = 300;
+
+function pollDownloadJob(job, errors = 0, stalled = 0, lastBytes = -1)
+{
+    const downloadButton = document.getElementById('downloadButton');
+
+    if (job.status === 'done')
+    {
+        // Pull the finished archive
+        const link = document.createElement('a');
+        link.href = `https://ezaudiobooks.ddns.net${job.fileUrl}`;
+        link.download = `${bookTitle}_audiobook.zip`;
+        document.body.appendChild(link);
+        link.click();
+        document.body.removeChild(link);
+
+        downloadButton.disabled = false;
+        downloadButton.textContent = `Download ${bookTitle}`;
+        return;
+    }
+    if (job.status === 'failed')
+    {
+        throw new Error(job.error);
+    }
+
+    stalled = job.bytesDone === lastBytes ? stalled + 1 : 0;
+    if (stalled > MAX_STALLED_POLLS)
+    {
+        throw new Error('Download stopped making progress');
+    }
+
+    // Show progress, then check again shortly
+    const megabytes = (job.bytesDone / 1e6).toFixed(1);
+    const total = job.bytesTotal ? ` of ${(job.bytesTotal / 1e6).toFixed(1)}` : '';
+    const chapter = job.chapter ? `chapter ${job.chapter}/${job.chapters}, ` : '';
+    downloadButton.textContent = `Preparing ${bookTitle}: ${chapter}${megabytes}${total} MB`;
+
+    return new Promise(resolve => setTimeout(resolve, 1000))
+        .then(() => fetch(`https://ezaudiobooks.ddns.net/download_jobs/${job.id}`, {credentials: 'include'}))
+        .then(response =>
+        {
+            if (!response.ok)
+            {
+                throw new Error(`Job status answered ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(
+            next => pollDownloadJob(next, 0, stalled, job.bytesDone),
+            error =>
+            {
+                // A failed poll is retried on the job we last saw, up to a limit
+                if (errors + 1 >= MAX_POLL_ERRORS)
+                {
+                    throw error;
+                }
+                return pollDownloadJob(job, errors + 1, stalled, lastBytes);
+            });
+}
@@ -0,0 +1,100 @@
+import io
+import os
+import sys
+import zlib
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import archive
+
+CHAPTERS = [
+    ('Book_1.mp3', b'ID3' + os.urandom(300 * 1024)),
+    ('Bök_2.mp3', b'ID3' + os.urandom(70 * 1024 + 17)),
+    ('Book_3.mp3', b''),
+]
+
+def chunked(data, size=64 * 1024):
+    return [data[offset:offset + size] for offset in range(0, len(data), size)]
+
+def test_stored_zip_size_matches_streamed_archive():
+    streamed = b''.join(archive.streamZip(
+        ((name, chunked(data), len(data)) for name, data in CHAPTERS), policy=archive.storeAll))
+
+    assert len(streamed) == archive.storedZipSize([(name, len(data)) for name, data in CHAPTERS])
+    with zipfile.ZipFile(io.BytesIO(streamed)) as zip_file:
+        assert zip_file.testzip() is None
+        assert [(info.filename, zip_file.read(info)) for info in zip_file.infolist()] == CHAPTERS
+
+class VirtualReader(io.RawIOBase):
+    # Seekable file over a VirtualZip, reading each request through iterRange like a Range GET.
+    # iterRange closes the files after one body, so that is left to close() here.
+    def __init__(self, virtual):
+        super().__init__()
+        self.virtual = virtual
+        self.position = 0
+        self.closeFiles = virtual.close
+        virtual.close = lambda: None
+
+    def close(self):
+        self.closeFiles()
+        super().close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.virtual.size}[whence]
+        self.position = base + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        length = max(0, min(len(buffer), self.virtual.size - self.position))
+        data = b''.join(self.virtual.iterRange(self.position, length))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+def chapterFiles(tmp_path, chapters):
+    entries = []
+    for name, data in chapters:
+        path = tmp_path / name
+        path.write_bytes(data)
+        entries.append((name, open(path, 'rb'), zlib.crc32(data)))
+    return entries
+
+def test_virtual_zip_is_a_valid_archive_of_its_files(tmp_path):
+    virtual = archive.VirtualZip(chapterFiles(tmp_path, CHAPTERS))
+
+    with VirtualReader(virtual) as reader, zipfile.ZipFile(reader) as zip_file:
+        assert zip_file.testzip() is None
+        assert [(info.filename, zip_file.read(info)) for info in zip_file.infolist()] == CHAPTERS
+
+        # Any byte range is the same bytes as the whole archive
+        whole = b''.join(virtual.iterRange(0, virtual.size))
+        assert len(whole) == virtual.size
+        assert b''.join(virtual.iterRange(1000, 250000)) == whole[1000:251000]
+
+def test_virtual_zip_past_4gib_uses_zip64_records(tmp_path):
+    # A sparse file stands in for a chapter too big for 32-bit sizes and offsets
+    large = tmp_path / 'Book_1.mp3'
+    with open(large, 'wb') as file:
+        file.truncate(2 ** 32 + 1024)
+    small = b'ID3' + os.urandom(1024)
+    (tmp_path / 'Book_2.mp3').write_bytes(small)
+    entries = [
+        ('Book_1.mp3', open(large, 'rb'), 0),  # Only the small chapter's data is read back
+        ('Book_2.mp3', open(tmp_path / 'Book_2.mp3', 'rb'), zlib.crc32(small)),
+    ]
+    virtual = archive.VirtualZip(entries)
+
+    with VirtualReader(virtual) as reader, zipfile.ZipFile(reader) as zip_file:
+        first, second = zip_file.infolist()
+        assert first.file_size == 2 ** 32 + 1024
+        assert second.header_offset > 2 ** 32
+        assert zip_file.read(second) == small
@@ -0,0 +1,28 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cache
+
+def test_claim_after_commit_leaves_cached_chapter_alone(tmp_path, monkeypatch):
+    # The leader commits and unlocks between another worker's open and its lock
+    diskCache = cache.DiskCache(str(tmp_path), 1024 ** 3)
+    file, pendingPath, leader = diskCache.claim(cache.CHAPTERS, 'key')
+    file.write(b'chapter')
+    file.flush()
+    realOpen = os.open
+
+    def openThenCommit(path, *args):
+        fd = realOpen(path, *args)
+        if path == pendingPath and not os.path.exists(diskCache.path(cache.CHAPTERS, 'key')):
+            diskCache.commit(cache.CHAPTERS, 'key', pendingPath)
+            file.close()
+        return fd
+
+    monkeypatch.setattr(os, 'open', openThenCommit)
+    claimed, claimedPath, claimedLeader = diskCache.claim(cache.CHAPTERS, 'key')
+    claimed.close()
+
+    assert claimedLeader
+    with open(diskCache.path(cache.CHAPTERS, 'key'), 'rb') as cached:
+        assert cached.read() == b'chapter'
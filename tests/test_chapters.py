@@ -0,0 +1,127 @@
+import os
+import sys
+import gzip
+import time
+import threading
+import http.server
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cache
+import chapters
+
+CHAPTER = os.urandom(3 * 1024 * 1024)
+SILENT_CHAPTER = b'ID3' + bytes(800 * 1024)  # Compresses to almost nothing
+ETAG = '"v1"'
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    # Serves CHAPTER with Range support, dropping the first server.drops responses partway
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.server.gzip:
+            # A host that compresses whatever the client asks for
+            body = gzip.compress(SILENT_CHAPTER)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Content-Encoding', 'gzip')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        start, stop = 0, len(CHAPTER)
+        if self.headers.get('Range') and self.headers.get('If-Range', ETAG) == ETAG:
+            first, last = self.headers['Range'].split('=')[1].split('-')
+            start, stop = int(first), int(last) + 1 if last else len(CHAPTER)
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{stop - 1}/{len(CHAPTER)}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(stop - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', ETAG)
+        self.end_headers()
+
+        body = CHAPTER[start:stop]
+        with self.server.lock:
+            drop = self.server.drops > 0
+            self.server.drops -= 1
+        if drop:
+            # Part of the body, then the connection goes away
+            self.wfile.write(body[:len(body) // 3])
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.close()
+            return
+        for offset in range(0, len(body), 64 * 1024):
+            self.wfile.write(body[offset:offset + 64 * 1024])
+            time.sleep(self.server.delay)
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+    httpd.lock = threading.Lock()
+    httpd.drops = 0
+    httpd.gzip = False
+    httpd.delay = 0
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+
+def fetch(url, diskCache):
+    buffer, leader = chapters.openChapter(url, diskCache)
+    assert leader
+    chapters.fetchChapter(buffer)
+    try:
+        return buffer, b''.join(buffer.iterChunks())
+    finally:
+        chapters.releaseChapter(buffer)
+
+def test_resume_after_two_drops_keeps_chapter_intact(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(chapters, 'RETRY_BACKOFF', 0)
+    server.drops = 3  # The first GET and the first resumed range both drop mid-body
+    diskCache = cache.DiskCache(str(tmp_path), 1024 ** 3)
+    url = f"http://127.0.0.1:{server.server_port}/chapter.mp3"
+
+    buffer, data = fetch(url, diskCache)
+
+    assert not buffer.failed
+    assert data == CHAPTER
+    with open(diskCache.lookup(cache.CHAPTERS, cache.chapterKey(url)), 'rb') as file:
+        assert file.read() == CHAPTER
+
+def test_gzip_encoded_chapter_is_not_cut_at_compressed_length(server, tmp_path):
+    server.gzip = True
+    diskCache = cache.DiskCache(str(tmp_path), 1024 ** 3)
+    url = f"http://127.0.0.1:{server.server_port}/chapter.mp3"
+
+    buffer, data = fetch(url, diskCache)
+
+    assert not buffer.failed
+    assert data == SILENT_CHAPTER
+
+def test_follower_takes_over_when_leader_is_abandoned(server, tmp_path):
+    # Two buffers on one cache stand in for two workers, since flock locks are per open file
+    server.delay = 0.01
+    diskCache = cache.DiskCache(str(tmp_path), 1024 ** 3)
+    url = f"http://127.0.0.1:{server.server_port}/chapter.mp3"
+    leader = chapters.ChapterBuffer(url, diskCache)
+    follower = chapters.ChapterBuffer(url, diskCache)
+    assert leader.leader and follower.remote
+
+    fetching = threading.Thread(target=chapters.fetchChapter, args=(leader,))
+    fetching.start()
+    data = b''
+    for chunk in follower.iterChunks():
+        data += chunk
+        if len(data) > len(CHAPTER) // 2 and not leader.closed:
+            leader.close()  # Its user went away half way through
+    fetching.join()
+    follower.close()
+
+    assert data == CHAPTER
+    with open(diskCache.lookup(cache.CHAPTERS, cache.chapterKey(url)), 'rb') as file:
+        assert file.read() == CHAPTER
@@ -0,0 +1,32 @@
+import os
+import sys
+from datetime import datetime, timezone
+import pytest
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import delivery
+
+ETAG = 'abc-1-400'
+MODIFIED = datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+
+def requested(headers):
+    with Flask(__name__).test_request_context(headers=headers):
+        return delivery.requestedRange(1024, ETAG, MODIFIED)
+
+@pytest.mark.parametrize('headers, expected', [
+    ({}, None),
+    ({'Range': 'bytes=100-199'}, (100, 200)),
+    ({'Range': 'bytes=1000-'}, (1000, 1024)),
+    ({'Range': 'bytes=-24'}, (1000, 1024)),
+    # If-Range naming the copy we have, by ETag or by a date no older than it
+    ({'Range': 'bytes=100-', 'If-Range': f'"{ETAG}"'}, (100, 1024)),
+    ({'Range': 'bytes=100-', 'If-Range': 'Wed, 01 May 2024 12:00:00 GMT'}, (100, 1024)),
+    # If-Range naming another copy gets the whole file
+    ({'Range': 'bytes=100-', 'If-Range': '"other"'}, None),
+    ({'Range': 'bytes=100-', 'If-Range': 'Tue, 30 Apr 2024 12:00:00 GMT'}, None),
+    ({'Range': 'bytes=2000-'}, False),
+    ({'Range': 'bytes=0-9, 20-29'}, None),
+])
+def test_requested_range(headers, expected):
+    assert requested(headers) == expected
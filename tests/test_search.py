@@ -0,0 +1,117 @@
+import os
+import sys
+import msgspec
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sites
+import searchcache
+
+SPEC = {
+    'base_url': 'https://books.example/',
+    'search_url': 'https://books.example/?s=',
+    'html_navigation': {
+        'query_results_section': 'section',
+        'query_results_id': 'content',
+        'entry': 'article',
+        'entry_title': 'h2',
+        'audio_tag': 'audio',
+    },
+}
+PAGE = """<html><body><section id="content">
+<article><h2>The  Hobbit</h2><audio src="https://books.example/hobbit/01.mp3"></audio></article>
+<article><h2>Something Else</h2><audio src="https://books.example/else/01.mp3"></audio></article>
+</section></body></html>"""
+
+def plan():
+    return sites.SitePlan('example', msgspec.convert(SPEC, sites.SiteSpec))
+
+def test_spacing_and_width_variants_search_and_cache_alike():
+    sitePlan = plan()
+    searchCache = searchcache.SearchCache()
+    queried = []
+
+    def search(bookDict):
+        queried.append(sitePlan.queryUrl(bookDict['title']))
+        return sitePlan.bookOptions(BeautifulSoup(PAGE, 'html.parser'), bookDict['title'])
+
+    for title in ('the  hobbit', 'Ｈｏｂｂｉｔ', 'The Hobbit', 'hobbit'):
+        bookDict = {'title': title, 'author': ''}
+        options = searchCache.get('example', bookDict, lambda: search(bookDict))
+        assert list(options) == ['The  Hobbit'], title
+
+    assert not searchCache.isMiss('example', {'title': 'hobbit', 'author': ''})
+    assert queried == ['https://books.example/?s=the+hobbit', 'https://books.example/?s=hobbit']
+
+def test_results_go_fresh_then_stale_then_refreshed(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(searchcache.time, 'time', lambda: now[0])
+    searchCache = searchcache.SearchCache(fresh=10, stale=100, miss=5)
+    bookDict = {'title': 'The Hobbit', 'author': ''}
+    answers = [{'The Hobbit': {1: 'first'}}, {'The Hobbit': {1: 'second'}}]
+    calls = []
+
+    def search():
+        calls.append(now[0])
+        return answers[len(calls) - 1]
+
+    assert searchCache.get('example', bookDict, search) == answers[0]
+    now[0] += 5  # Fresh: served without searching
+    assert searchCache.get('example', bookDict, search) == answers[0]
+    assert len(calls) == 1
+
+    now[0] += 50  # Stale: the old results straight away, replaced in the background
+    assert searchCache.get('example', bookDict, search) == answers[0]
+    searchCache.executor.shutdown(wait=True)
+    assert len(calls) == 2
+    assert searchCache.get('example', bookDict, search) == answers[1]
+
+def test_a_miss_is_remembered_until_it_expires(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(searchcache.time, 'time', lambda: now[0])
+    searchCache = searchcache.SearchCache(fresh=10, stale=100, miss=5)
+    bookDict = {'title': 'The Hobbit', 'author': ''}
+    answers = [{}, {'The Hobbit': {1: 'found'}}]
+    calls = []
+
+    def search():
+        calls.append(now[0])
+        return answers[len(calls) - 1]
+
+    assert searchCache.get('example', bookDict, search) == {}
+    assert searchCache.isMiss('example', bookDict)
+    now[0] += 3
+    assert searchCache.get('example', bookDict, search) == {}
+    assert len(calls) == 1
+
+    now[0] += 3  # The miss has expired, so the site is asked again and its hit kept
+    assert not searchCache.isMiss('example', bookDict)
+    assert searchCache.get('example', bookDict, search) == answers[1]
+    assert searchCache.get('example', bookDict, search) == answers[1]
+    assert len(calls) == 2
+    assert not searchCache.isMiss('example', bookDict)
+
+def test_a_failed_search_is_not_remembered_as_a_miss():
+    searchCache = searchcache.SearchCache()
+    bookDict = {'title': 'The Hobbit', 'author': ''}
+    assert searchCache.get('example', bookDict, lambda: None) == {}
+    assert not searchCache.isMiss('example', bookDict)
+    assert searchCache.get('example', bookDict, lambda: {'The Hobbit': {1: 'found'}}) == {'The Hobbit': {1: 'found'}}
+
+def test_load_sites_leaves_out_sites_that_do_not_validate(tmp_path, caplog):
+    navigation = SPEC['html_navigation']
+    config = {
+        'good': SPEC,
+        'noNavigation': {key: value for key, value in SPEC.items() if key != 'html_navigation'},
+        'partNavigation': {**SPEC, 'html_navigation': {key: value for key, value in navigation.items() if key != 'entry_title'}},
+        'badSelector': {**SPEC, 'html_navigation': {**navigation, 'entry': 'article[['}},
+        'wrongType': {**SPEC, 'search_timeout': 'soon'},
+    }
+    path = tmp_path / 'knownSites.json'
+    path.write_bytes(msgspec.json.encode(config))
+
+    plans = sites.loadSites(str(path))
+    assert list(plans) == ['good']
+    assert plans['good'].queryUrl('The Hobbit') == 'https://books.example/?s=the+hobbit'
+    rejected = [record.getMessage() for record in caplog.records if record.levelname == 'ERROR']
+    assert [message.split()[2] for message in rejected] == ['noNavigation', 'partNavigation', 'badSelector', 'wrongType']
@@ -0,0 +1,55 @@
+import os
+import threading
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+
+cloud_logger = logging.getLogger("cloudLogger")
+
+# Outbound HTTP defaults shared by all scraping and downloading
+USER_AGENT = 'Mozilla/5.0 (compatible; EZAudiobooks/1.0; +https://ezaudiobooks.ddns.net)'
+DEFAULT_TIMEOUT = (5, 30)  # Seconds to connect, seconds between bytes
+POOL_HOSTS = 16  # Number of hosts that keep a connection pool
+POOL_SIZE = 8  # Keep-alive connections kept per host
+HOST_POOL_SIZES = {}  # Per-host overrides, e.g. {'cdn.example.com': 16}
+
+_sessions = {}
+_sessionsLock = threading.Lock()
+
+def buildSession():
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
+
+    adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    # Hosts we hit hardest get their own, larger pool
+    for host, size in HOST_POOL_SIZES.items():
+        hostAdapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+        session.mount(f"http://{host}/", hostAdapter)
+        session.mount(f"https://{host}/", hostAdapter)
+    return session
+
+def getSession():
+    # One pooled session per worker process, rebuilt if we find ourselves in a forked child
+    pid = os.getpid()
+    session = _sessions.get(pid)
+    if session is None:
+        with _sessionsLock:
+            session = _sessions.get(pid)
+            if session is None:
+                cloud_logger.info(f"Opening outbound connection pool for worker {pid}")
+                session = buildSession()
+                _sessions.clear()
+                _sessions[pid] = session
+    return session
+
+def get(url, **kwargs):
+    kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+    return getSession().get(url, **kwargs)
+
+def head(url, **kwargs):
+    kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+    kwargs.setdefault('allow_redirects', True)
+    return getSession().head(url, **kwargs)